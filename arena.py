@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 """Arena class"""
 
+from array import array
+from itertools import compress
+
 class Arena(object):
 
     """Represent a 2D arena whose coord spaces are stackable"""
@@ -10,6 +13,9 @@ class Arena(object):
         self.cols = cols
         self.rows = rows
         self.data = [[] for _ in xrange(rows*cols)]
+        self.version = 0 # bumped on every change, so that observers can tell when to update
+        self.dirty = set() # indexes changed since the last take_dirty()
+        self.handles = {} # object -> index, for objects that are in the arena once
 
     def sanity(self, coords):
         """Ensure that coords are within sane limits"""
@@ -17,15 +23,42 @@ class Arena(object):
         if not (0 <= x < self.cols) or not (0 <= y < self.rows):
             raise IndexError("Coords (%d, %d) are not valid: must be in range (0, 0) to (%d, %d)" % (x, y, self.cols-1, self.rows-1))
 
-    def _get_list(self, coords):
+    def coords_index(self, coords):
         """The 2D -> 1D convertermatron"""
-        self.sanity(coords)
         x, y = coords
-        return self.data[x+y*self.cols]
+        if 0 <= x < self.cols and 0 <= y < self.rows:
+            return x+y*self.cols
+
+        self.sanity(coords) # raises
+
+    def _get_list(self, coords):
+        """Get the list for a set of coords"""
+        return self.data[self.coords_index(coords)]
+
+    def index_get(self, i):
+        """Get the list of objects at an index"""
+        return self.data[i]
+
+    def _changed(self, *indexes):
+        """Note a change to the lists at one or more indexes"""
+        self.version += 1
+        self.dirty.update(indexes)
+
+    def take_dirty(self):
+        """Hand over the indexes changed since the last call, starting afresh"""
+        dirty, self.dirty = self.dirty, set()
+        return dirty
 
     def coords_add(self, coords, obj):
         """Add an object by coords"""
-        self._get_list(coords).append(obj)
+        i = self.coords_index(coords)
+        self.data[i].append(obj)
+        self.handles[obj] = i
+        self._changed(i)
+
+    def coords_touch(self, coords):
+        """Note a change to an object at a set of coords that leaves it there"""
+        self._changed(self.coords_index(coords))
 
     def coords_get_real(self, coords):
         """Get the list of objects at a set of coords"""
@@ -37,12 +70,43 @@ class Arena(object):
 
     def coords_remove(self, coords, obj):
         """Remove an object by coords"""
-        for i, o in enumerate(self._get_list(coords)):
-            if o == obj:
-                del self._get_list(coords)[i]
-                return o
+        i = self.coords_index(coords)
+        o = self._list_remove(self.data[i], obj, coords)
+        if self.handles.get(obj) == i:
+            del self.handles[obj]
+        self._changed(i)
+        return o
+
+    @staticmethod
+    def _list_remove(l, obj, coords):
+        """Remove an object from the list for a coord space"""
+        try:
+            return l.pop(l.index(obj))
+        except ValueError:
+            raise LookupError("Did not find object %r at %s" % (obj, str(coords)))
 
-        raise LookupError("Did not find object %r at %s" % (obj, str(coords)))
+    def _handle(self, obj):
+        """The index of an object that is in the arena once"""
+        try:
+            return self.handles[obj]
+        except KeyError:
+            raise LookupError("Did not find object %r" % (obj,))
+
+    def remove(self, obj):
+        """Remove an object without needing its coords"""
+        i = self._handle(obj)
+        o = self._list_remove(self.data[i], obj, (i % self.cols, i // self.cols))
+        del self.handles[obj]
+        self._changed(i)
+        return o
+
+    def move(self, obj, new_coords):
+        """Move an object to a new set of coords, as a single change"""
+        i = self._handle(obj)
+        j = self.coords_index(new_coords)
+        self.data[j].append(self._list_remove(self.data[i], obj, (i % self.cols, i // self.cols)))
+        self.handles[obj] = j
+        self._changed(i, j)
 
     # TODO: maybe implement the "have" functions separately so we can use them when iterating, e.g. in GameState.spawn()
 
@@ -68,3 +132,312 @@ class Arena(object):
             x = i % self.cols
             y = i / self.cols
             yield x, y, l
+
+class IndexedArena(Arena):
+
+    """
+    Arena that also keeps a bitmask per coord space of the (registered) classes
+    present, so that testing for a class is a single integer test, and an
+    index of the coords holding each of the located classes
+
+    Terrain, objects of classes that never move, is kept as a code per coord
+    space rather than as objects; the first object added of each terrain class
+    is kept as a prototype, whose at(coords) method gives the object to hand
+    out for a set of coords. Everything else is kept in lists, but only for
+    the coord spaces that have something in them.
+
+    Coord spaces holding any of the blocking classes are flagged in blocked,
+    one byte per coord space, for movement checks and pathfinding.
+    """
+
+    def __init__(self, cols, rows, classes, located=None, terrain=(), blocking=()):
+        """
+        Create the data structure, assigning a bit to each registered class;
+        located classes (all of them, by default) also have their coords indexed
+        """
+        self.cols = cols
+        self.rows = rows
+        self.version = 0
+        self.dirty = set()
+
+        self.classes = tuple(classes)
+        if len(self.classes) > 32:
+            raise ValueError("Too many classes to index: %d (max 32)" % len(self.classes))
+
+        self.bits = dict((c, 1 << n) for n, c in enumerate(self.classes))
+        self.masks = array('I', [0]) * (rows*cols)
+        if located is None:
+            located = self.classes
+        self.index = dict((c, set()) for c in located)
+        self._located_bits = dict((self.bits[c], coords_set) for c, coords_set in self.index.items())
+        self._type_masks = {}
+
+        self.terrain_classes = (None,) + tuple(terrain) # code 0 is no terrain
+        if len(self.terrain_classes) > 256:
+            raise ValueError("Too many terrain classes: %d (max 255)" % len(terrain))
+
+        self._terrain_codes = dict((c, n) for n, c in enumerate(self.terrain_classes) if c is not None)
+        self._terrain_protos = {}
+        self.terrain = array('B', [0]) * (rows*cols)
+        self.entities = {} # index -> list of objects, for coord spaces holding more than terrain
+        self.handles = {} # object -> index, for everything but terrain
+
+        self._blocking_mask = self.mask_for(*blocking)
+        self.blocked = bytearray(rows*cols)
+
+    @property
+    def data(self):
+        """The list of objects at each coord space; built on demand, so only for debugging"""
+        return [self.index_get(i) for i in xrange(self.rows*self.cols)]
+
+    def index_get(self, i):
+        """Get a list of the objects at an index"""
+        objs = self.entities.get(i, [])
+        code = self.terrain[i]
+        if code:
+            return [self._terrain_protos[code].at((i % self.cols, i // self.cols))] + objs
+
+        return objs[:]
+
+    def _get_list(self, coords):
+        """Get a list of the objects at a set of coords"""
+        return self.index_get(self.coords_index(coords))
+
+    def coords_get_real(self, coords):
+        """There is no list of objects kept for a set of coords, so this is a copy too"""
+        return self._get_list(coords)
+
+    def coords_get(self, coords):
+        """Get a list of the objects at a set of coords"""
+        return self._get_list(coords)
+
+    def type_mask(self, cls):
+        """The mask of registered classes that instances of cls are an instance of"""
+        try:
+            return self._type_masks[cls]
+        except KeyError:
+            mask = 0
+            for c, bit in self.bits.items():
+                if cls is not None and issubclass(cls, c):
+                    mask |= bit
+
+            self._type_masks[cls] = mask
+            return mask
+
+    def mask_for(self, *classes):
+        """Combine the bits of the given (registered) classes into a single mask"""
+        mask = 0
+        for c in classes:
+            mask |= self.bits[c]
+
+        return mask
+
+    def _mask_update(self, i, coords, new):
+        """Set the mask for an index, keeping the class -> coords index in step"""
+        changed = self.masks[i] ^ new
+        if not changed:
+            return
+
+        self.masks[i] = new
+        self.blocked[i] = 1 if new & self._blocking_mask else 0
+        coords = tuple(coords)
+        located_bits = self._located_bits
+        while changed:
+            bit = changed & -changed
+            changed ^= bit
+            coords_set = located_bits.get(bit)
+            if coords_set is None:
+                continue
+
+            if new & bit:
+                coords_set.add(coords)
+            else:
+                coords_set.discard(coords)
+
+    def _terrain_at(self, i, coords, obj):
+        """Whether obj is the terrain at an index"""
+        code = self._terrain_codes.get(type(obj))
+        return code is not None and self.terrain[i] == code and obj.coords in (None, tuple(coords))
+
+    def coords_add(self, coords, obj):
+        """Add an object by coords"""
+        i = self.coords_index(coords)
+        code = self._terrain_codes.get(type(obj))
+        if code is not None and not self.terrain[i]:
+            self.terrain[i] = code
+            self._terrain_protos.setdefault(code, obj)
+        else:
+            self._entity_add(i, obj)
+
+        self._changed(i)
+        try:
+            type_mask = self._type_masks[type(obj)]
+        except KeyError:
+            type_mask = self.type_mask(type(obj))
+        self._mask_update(i, coords, self.masks[i] | type_mask)
+
+    def terrain_load(self, codes, protos):
+        """
+        Fill an arena that has nothing in it yet with terrain, from a string of
+        codes as kept in self.terrain; protos gives the object for each code
+        that copies are handed out of. Nothing is marked as changed, so
+        anything rendered from the arena needs redrawing
+        """
+        self.terrain = array('B', codes)
+        self._terrain_protos.update(protos)
+
+        # per code lookups, as there are far fewer codes than coord spaces
+        code_masks = [0] * 256
+        for code, cls in enumerate(self.terrain_classes):
+            if cls is not None:
+                code_masks[code] = self.type_mask(cls)
+        self.masks = array('I', map(code_masks.__getitem__, self.terrain))
+        self.blocked = bytearray(codes.translate(''.join(chr(1 if mask & self._blocking_mask else 0) for mask in code_masks)))
+
+        cols = self.cols
+        for code, mask in enumerate(code_masks):
+            coords_sets = [s for bit, s in self._located_bits.items() if mask & bit]
+            if not coords_sets:
+                continue
+
+            # a byte per coord space, set where the code is
+            here = bytearray(codes.translate('\0' * code + '\1' + '\0' * (255 - code)))
+            coords = [(i % cols, i // cols) for i in compress(xrange(len(here)), here)]
+            for s in coords_sets:
+                s.update(coords)
+
+    def _entity_add(self, i, obj):
+        """Add an object to the list for an index"""
+        try:
+            self.entities[i].append(obj)
+        except KeyError:
+            self.entities[i] = [obj]
+
+        self.handles[obj] = i
+
+    def _entity_remove(self, i, obj, coords):
+        """Remove an object from the list for an index, dropping the list if that empties it"""
+        objs = self.entities.get(i, [])
+        o = self._list_remove(objs, obj, coords)
+        if not objs:
+            del self.entities[i]
+        if self.handles.get(obj) == i:
+            del self.handles[obj]
+
+        return o
+
+    def _mask_rebuild(self, i, coords):
+        """Recalculate the mask for an index from what is left there"""
+        type_masks = self._type_masks # everything in the arena has been through type_mask()
+        new = type_masks[self.terrain_classes[self.terrain[i]]] if self.terrain[i] else 0
+        for o in self.entities.get(i, ()):
+            new |= type_masks[type(o)]
+
+        self._mask_update(i, coords, new)
+
+    def coords_remove(self, coords, obj):
+        """Remove an object by coords, recalculating the mask for those coords"""
+        i = self.coords_index(coords)
+        if self._terrain_at(i, coords, obj):
+            self.terrain[i] = 0
+        else:
+            self._entity_remove(i, obj, coords)
+
+        self._changed(i)
+        self._mask_rebuild(i, coords)
+        return obj
+
+    def remove(self, obj):
+        """Remove an object without needing its coords; terrain is found by its coords instead"""
+        try:
+            i = self.handles.pop(obj)
+        except KeyError:
+            return self.coords_remove(obj.coords, obj)
+
+        objs = self.entities[i]
+        if len(objs) == 1:
+            del self.entities[i]
+        else:
+            objs.remove(obj)
+
+        coords = (i % self.cols, i // self.cols)
+        self._changed(i)
+        self._mask_rebuild(i, coords)
+        return obj
+
+    def move(self, obj, new_coords):
+        """Move an object (other than terrain) to a new set of coords, as a single change"""
+        i = self._handle(obj)
+        j = self.coords_index(new_coords)
+        objs = self.entities[i]
+        if len(objs) == 1:
+            del self.entities[i]
+        else:
+            objs.remove(obj)
+
+        self._entity_add(j, obj)
+        coords = (i % self.cols, i // self.cols)
+        self._changed(i, j)
+        self._mask_rebuild(i, coords)
+        self._mask_update(j, new_coords, self.masks[j] | self.type_mask(type(obj)))
+
+    def coords_have_obj(self, coords, obj):
+        """Test for an object by coords"""
+        i = self.coords_index(coords)
+        if self.handles.get(obj) == i or self._terrain_at(i, coords, obj):
+            return True
+
+        for o in self.entities.get(i, ()):
+            if o == obj:
+                return True
+
+        return False
+
+    def passable(self, coords):
+        """Whether coords are in the arena and free of blocking classes; never raises"""
+        x, y = coords
+        return 0 <= x < self.cols and 0 <= y < self.rows and not self.blocked[x+y*self.cols]
+
+    def coords_have_mask(self, coords, mask):
+        """Test for any of the classes in a mask (see mask_for) by coords"""
+        return bool(self.masks[self.coords_index(coords)] & mask)
+
+    def coords_have_class(self, coords, classref):
+        """Test for a class by coords, falling back to a scan for unregistered classes"""
+        try:
+            bit = self.bits[classref]
+        except KeyError:
+            return super(IndexedArena, self).coords_have_class(coords, classref)
+
+        return bool(self.masks[self.coords_index(coords)] & bit)
+
+    def terrain_count(self, classref):
+        """How many coord spaces hold a terrain class"""
+        return self.terrain.count(self._terrain_codes[classref])
+
+    def class_coords(self, classref):
+        """Get a set of the coords holding a class, falling back to a scan for classes that aren't located"""
+        if classref in self.index:
+            return set(self.index[classref])
+
+        if classref in self.bits:
+            bit = self.bits[classref]
+            return set((i % self.cols, i // self.cols) for i, mask in enumerate(self.masks) if mask & bit)
+
+        return set((x, y) for x, y, l in self if any(isinstance(o, classref) for o in l))
+
+    def __iter__(self):
+        """Iterate over the coords, providing x, y, list"""
+        cols = self.cols
+        entities = self.entities
+        protos = self._terrain_protos
+        for i, code in enumerate(self.terrain):
+            x, y = i % cols, i // cols
+            objs = entities.get(i)
+            if code:
+                l = [protos[code].at((x, y))]
+                if objs:
+                    l.extend(objs)
+                yield x, y, l
+            else:
+                yield x, y, objs[:] if objs else []
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+"""Many games at once, stepped in lockstep as NumPy arrays"""
+
+from bomber import GameState, Player, Block, DestructibleBlock, SpawnPoint, Bomb, PowerupFlame, PowerupBomb
+from bomber import DIRECTIONS, FLAME_KINDS, ARMS_VT, ARMS_HZ
+import numpy as np
+import random
+
+# terrain codes
+EMPTY, BLOCK, DESTRUCTIBLE, SPAWN = xrange(4)
+TERRAIN_CHRS = ' ', Block.DEBUG_CHR, DestructibleBlock.DEBUG_CHR, SpawnPoint.DEBUG_CHR
+
+# powerup codes
+NO_POWERUP, POWERUP_FLAME, POWERUP_BOMB = xrange(3)
+POWERUP_CHRS = ' ', PowerupFlame.DEBUG_CHR, PowerupBomb.DEBUG_CHR
+
+# explosion work: bombs due, bombs bursting and flames spreading a step
+DUE, BURST, INCINERATE = xrange(1, 4)
+
+class BatchGame(object):
+
+    """
+    A batch of games on the same arena, played by the same number of players,
+    each game kept as a row of the arrays below; step() plays a tick of every
+    game, with the same results as GameState.tick() on each of them
+
+    Explosions are resolved from a work stack per game, as in GameState, but
+    the stacks are worked through together: each pass takes the work off the
+    top of every stack that has any, so that the order within each game is
+    unchanged and chain reactions come out the same.
+
+    Powerups are rolled from a random.Random per game, seeded as given, as
+    they are by a GameState with the same seed.
+    """
+
+    RANDOM_BUFFER = 64 # rolls drawn ahead per game
+
+    def __init__(self, lines, games, players, seeds=None):
+        """Build the games from lines in the same format as the map files, and spawn the players"""
+        state = GameState(arena=None)
+        state.arena_build(lines)
+        arena = state.arena
+        self.cols, self.rows = arena.cols, arena.rows
+        self.games, self.players = games, players
+        cells = self.cols * self.rows
+
+        codes = {None: EMPTY, Block: BLOCK, DestructibleBlock: DESTRUCTIBLE, SpawnPoint: SPAWN}
+        terrain = np.array([codes[arena.terrain_classes[code]] for code in arena.terrain], dtype=np.int8)
+        self.terrain = np.tile(terrain, (games, 1))
+        self.reach = np.array(state._reach, dtype=np.int32).reshape(cells, len(DIRECTIONS))
+        self.offsets = np.array([dx + dy*self.cols for dx, dy in DIRECTIONS], dtype=np.int32)
+
+        self.powerup = np.zeros((games, cells), dtype=np.int8)
+        self.flame_arms = np.zeros((games, cells), dtype=np.int8)
+        self.flame_player = np.zeros((games, cells), dtype=np.int32) # the player whose bomb lit the flame
+
+        # bombs, at most one per coord space
+        self.bomb_owner = np.full((games, cells), -1, dtype=np.int32) # who dropped it; -1 for no bomb
+        self.bomb_player = np.zeros((games, cells), dtype=np.int32) # who gets the credit, which changes when flamed
+        self.bomb_flame = np.zeros((games, cells), dtype=np.int32)
+        self.bomb_fuse = np.zeros((games, cells), dtype=np.int32) # the bomb tick it explodes on
+        self.bomb_seq = np.zeros((games, cells), dtype=np.int64) # the order the bombs were dropped in
+        self.bomb_exploded = np.zeros((games, cells), dtype=bool)
+        self.bomb_count = 0
+        self.now = 0 # bomb ticks so far
+
+        # players; pos is the index of their coords, or -1 when they're not in the arena
+        self.pos = np.full((games, players), -1, dtype=np.int32)
+        self.number = np.zeros((games, players), dtype=np.int32)
+        self.flame = np.ones((games, players), dtype=np.int32)
+        self.bomb = np.ones((games, players), dtype=np.int32)
+        self.bombs_live = np.zeros((games, players), dtype=np.int32)
+        self.kills = np.zeros((games, players), dtype=np.int32)
+        self.deaths = np.zeros((games, players), dtype=np.int32)
+        self.suicides = np.zeros((games, players), dtype=np.int32)
+        self.sticky = np.zeros((games, players), dtype=np.int32)
+        self.arrived = np.zeros((games, players), dtype=np.int64) # when they arrived at their coords, to stack them
+        self.arrivals = 0
+
+        # explosion work stacks
+        self._stack = np.zeros((games, 16, 6), dtype=np.int32) # (kind, cell, direction, flame, reach, player)
+        self._depth = np.zeros(games, dtype=np.int32)
+
+        if seeds is None:
+            seeds = range(games)
+        self._rngs = [random.Random(seed) for seed in seeds]
+        self._rolls = np.zeros((games, self.RANDOM_BUFFER))
+        self._rolled = np.zeros(games, dtype=np.int32)
+        for g in xrange(games):
+            self._roll_refill(g)
+
+        # spawn in reading order, as GameState.spawn does
+        for n, cell in enumerate(np.flatnonzero(terrain == SPAWN)[:players]):
+            self.pos[:, n] = cell
+            self.number[:, n] = n + 1
+            self._arrive(np.arange(games), np.full(games, n))
+
+    def _roll_refill(self, g):
+        """Draw the next rolls for a game"""
+        rng = self._rngs[g]
+        self._rolls[g] = [rng.random() for _ in xrange(self.RANDOM_BUFFER)]
+        self._rolled[g] = 0
+
+    def _roll(self, gs):
+        """The next roll for each of the games gs"""
+        for g in gs[self._rolled[gs] >= self.RANDOM_BUFFER]:
+            self._roll_refill(g)
+
+        rolls = self._rolls[gs, self._rolled[gs]]
+        self._rolled[gs] += 1
+        return rolls
+
+    def _arrive(self, gs, ps):
+        """Note players arriving at their coords, after anyone already there"""
+        self.arrived[gs, ps] = self.arrivals + np.arange(len(gs))
+        self.arrivals += len(gs)
+
+    def _push(self, gs, kind, cell, direction, flame, reach, player):
+        """Push explosion work onto the stacks of the games gs, which must be distinct"""
+        if not len(gs):
+            return
+
+        if self._depth.max() >= self._stack.shape[1]:
+            self._stack = np.concatenate([self._stack, np.zeros_like(self._stack)], axis=1)
+
+        depth = self._depth[gs]
+        self._stack[gs, depth] = np.stack(np.broadcast_arrays(kind, cell, direction, flame, reach, player), axis=-1)
+        self._depth[gs] = depth + 1
+
+    def _die(self, gs, ps, killers):
+        """Players ps of games gs catch fire from the bombs of players killers"""
+        if not len(gs):
+            return
+
+        self.deaths[gs, ps] += 1
+        suicide = killers == ps
+        self.suicides[gs, ps] += suicide
+        np.add.at(self.kills, (gs[~suicide], killers[~suicide]), 1)
+        self.pos[gs, ps] = -1
+        self.sticky[gs, ps] = 0
+
+    def _ignite(self, gs, cells, arms, players):
+        """Set cells alight, merging with any flames there, and flame what's in them"""
+        burning = self.flame_arms[gs, cells] != 0
+        players = np.where(burning, self.flame_player[gs, cells], players)
+        self.flame_player[gs, cells] = players
+        self.flame_arms[gs, cells] |= arms
+
+        bombs = (self.bomb_owner[gs, cells] >= 0) & ~self.bomb_exploded[gs, cells]
+        self.bomb_player[gs[bombs], cells[bombs]] = players[bombs]
+        self.bomb_exploded[gs[bombs], cells[bombs]] = True
+        self._push(gs[bombs], BURST, cells[bombs], 0, 0, 0, 0)
+
+        hit_games, hit_players = np.nonzero(self.pos[gs] == cells[:, None])
+        self._die(gs[hit_games], hit_players, players[hit_games])
+
+        self.powerup[gs, cells] = NO_POWERUP
+
+        blocks = self.terrain[gs, cells] == DESTRUCTIBLE
+        gs, cells = gs[blocks], cells[blocks]
+        self.terrain[gs, cells] = EMPTY
+        rolls = self._roll(gs)
+        self.powerup[gs, cells] = np.where(rolls < 0.15, POWERUP_FLAME, np.where(rolls < 0.30, POWERUP_BOMB, NO_POWERUP))
+
+    def _burst(self, gs, cells):
+        """Bombs burst: flame their coords and send the flames out in each direction"""
+        flames = self.bomb_flame[gs, cells]
+        players = self.bomb_player[gs, cells]
+        self.bombs_live[gs, self.bomb_owner[gs, cells]] -= 1
+        self.bomb_owner[gs, cells] = -1
+        self.bomb_exploded[gs, cells] = False
+
+        # the last direction first, as the stack is last in, first out
+        for direction in reversed(xrange(len(DIRECTIONS))):
+            reach = np.minimum(flames, self.reach[cells, direction])
+            ok = reach > 0
+            self._push(gs[ok], INCINERATE, cells[ok], direction, flames[ok], reach[ok], players[ok])
+
+        self._ignite(gs, cells, ARMS_VT | ARMS_HZ, players)
+
+    def _incinerate(self, gs, cells, directions, flames, reach, players):
+        """Spread flames a step, queueing the next step while within reach"""
+        cells = cells + self.offsets[directions]
+        onward = (flames > 1) & (self.terrain[gs, cells] != DESTRUCTIBLE)
+        more = onward & (reach > 1)
+        self._push(gs[more], INCINERATE, cells[more], directions[more], flames[more]-1, reach[more]-1, players[more])
+
+        arms = np.where(onward, np.where(directions < 2, ARMS_VT, ARMS_HZ), 1 << directions)
+        self._ignite(gs, cells, arms, players)
+
+    def _blasts_resolve(self):
+        """Work through every game's explosion stack, a piece of work from each per pass"""
+        while True:
+            gs = np.flatnonzero(self._depth)
+            if not len(gs):
+                return
+
+            self._depth[gs] -= 1
+            kind, cells, directions, flames, reach, players = self._stack[gs, self._depth[gs]].T
+
+            due = kind == DUE
+            due_gs, due_cells = gs[due], cells[due]
+            due_ok = (self.bomb_owner[due_gs, due_cells] >= 0) & ~self.bomb_exploded[due_gs, due_cells]
+            due_gs, due_cells = due_gs[due_ok], due_cells[due_ok]
+            self.bomb_exploded[due_gs, due_cells] = True
+            self._push(due_gs, BURST, due_cells, 0, 0, 0, 0)
+
+            burst = kind == BURST
+            self._burst(gs[burst], cells[burst])
+
+            inc = kind == INCINERATE
+            self._incinerate(gs[inc], cells[inc], directions[inc], flames[inc], reach[inc], players[inc])
+
+    def _flames_process(self):
+        """Every flame burns out on the flame tick after it was lit"""
+        self.flame_arms[:] = 0
+
+    def _actions_process(self, actions):
+        """
+        Players with an action go first, in order, then the others repeat their
+        sticky action; actions are as for Player, with 0 for none
+        """
+        gs = np.arange(self.games)
+        ps = np.arange(self.players)
+        queued_all = actions != 0
+        order = np.argsort(np.where(queued_all, ps, ps + self.players), axis=1)
+        for turn in xrange(self.players):
+            p = order[:, turn]
+            queued = queued_all[gs, p]
+            action = np.where(queued, actions[gs, p], self.sticky[gs, p])
+            alive = self.pos[gs, p] >= 0
+            acting = alive & (action != 0)
+
+            bombing = acting & (action == Player.BOMB)
+            bg, bp = gs[bombing], p[bombing]
+            cells = self.pos[bg, bp]
+            drop = (self.bomb_owner[bg, cells] < 0) & (self.bombs_live[bg, bp] < self.bomb[bg, bp])
+            bg, bp, cells = bg[drop], bp[drop], cells[drop]
+            self.bomb_owner[bg, cells] = bp
+            self.bomb_player[bg, cells] = bp
+            self.bomb_flame[bg, cells] = self.flame[bg, bp]
+            self.bomb_fuse[bg, cells] = self.now + Bomb.FUSE
+            self.bomb_seq[bg, cells] = self.bomb_count + np.arange(len(bg))
+            self.bomb_count += len(bg)
+            self.bombs_live[bg, bp] += 1
+
+            moving = acting & (action >= Player.UP) & (action <= Player.RIGHT)
+            direction = np.clip(action - Player.UP, 0, 3) # Player.UP..RIGHT are in the order of DIRECTIONS
+            dx = np.array([d[0] for d in DIRECTIONS])[direction]
+            dy = np.array([d[1] for d in DIRECTIONS])[direction]
+            x = self.pos[gs, p] % self.cols + dx
+            y = self.pos[gs, p] // self.cols + dy
+            inside = (x >= 0) & (x < self.cols) & (y >= 0) & (y < self.rows)
+            target = np.where(inside, x + y*self.cols, 0)
+            passable = inside & (self.terrain[gs, target] != BLOCK) & (self.terrain[gs, target] != DESTRUCTIBLE) \
+                              & (self.bomb_owner[gs, target] < 0)
+
+            mg, mp, cells = gs[moving & passable], p[moving & passable], target[moving & passable]
+            self.pos[mg, mp] = cells
+            self._arrive(mg, mp)
+            burning = self.flame_arms[mg, cells] != 0
+            self._die(mg[burning], mp[burning], self.flame_player[mg[burning], cells[burning]])
+            powerup = self.powerup[mg, cells]
+            self.flame[mg, mp] += powerup == POWERUP_FLAME
+            self.bomb[mg, mp] += powerup == POWERUP_BOMB
+            self.powerup[mg, cells] = NO_POWERUP
+
+            # queued actions become sticky, unless they're bombs; sticky moves that are blocked stop
+            still_alive = self.pos[gs, p] >= 0
+            sticky = queued & alive & still_alive
+            self.sticky[gs[sticky], p[sticky]] = np.where(action[sticky] == Player.BOMB, 0, action[sticky])
+            stop = ~queued & moving & ~passable
+            self.sticky[gs[stop], p[stop]] = 0
+
+    def _bombs_process(self):
+        """Bombs whose time has come explode, the first dropped first"""
+        self.now += 1
+        gs, cells = np.nonzero((self.bomb_owner >= 0) & (self.bomb_fuse == self.now))
+        if len(gs):
+            # pushed last dropped first, so that the first dropped is on top of each stack
+            order = np.lexsort((-self.bomb_seq[gs, cells], gs))
+            gs, cells = gs[order], cells[order]
+            while len(gs):
+                first = np.ones(len(gs), dtype=bool)
+                first[1:] = gs[1:] != gs[:-1]
+                self._push(gs[first], DUE, cells[first], 0, 0, 0, 0)
+                gs, cells = gs[~first], cells[~first]
+
+        self._blasts_resolve()
+
+    def step(self, actions=None):
+        """Play a tick of every game; actions is a games x players array"""
+        if actions is None:
+            actions = np.zeros((self.games, self.players), dtype=np.int32)
+
+        self._flames_process()
+        self._actions_process(np.asarray(actions))
+        self._bombs_process()
+
+    def render(self, g):
+        """A game rendered in the same format as str(GameState)"""
+        rows = []
+        for y in xrange(self.rows):
+            row = []
+            for x in xrange(self.cols):
+                row.append(self._glyph(g, x + y*self.cols))
+            rows.append(''.join(row))
+
+        return '\n'.join(rows) + '\n'
+
+    def _glyph(self, g, cell):
+        """The character for a coord space: that of the object on top"""
+        if self.flame_arms[g, cell]:
+            return FLAME_KINDS[self.flame_arms[g, cell]].DEBUG_CHR
+
+        here = [p for p in xrange(self.players) if self.pos[g, p] == cell]
+        if here:
+            number = self.number[g, min(here, key=lambda p: self.arrived[g, p])]
+            return str(number) if -1 < number < 10 else Player.DEBUG_CHR
+
+        if self.bomb_owner[g, cell] >= 0:
+            return Bomb.DEBUG_CHR
+
+        if self.terrain[g, cell] != EMPTY:
+            return TERRAIN_CHRS[self.terrain[g, cell]]
+
+        return POWERUP_CHRS[self.powerup[g, cell]]
+
+    def coords(self, g, p):
+        """A player's coords, or None when they're not in the arena"""
+        pos = self.pos[g, p]
+        return None if pos < 0 else (int(pos % self.cols), int(pos // self.cols))
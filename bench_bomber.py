@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+"""Benchmarks for bomber module"""
+
+from bomber import *
+from headless import Headless, random_bots
+from replay import InputLog, Replay, ReplayWriter, ReplayReader, CrashLog
+from metrics import TickMetrics
+from array import array
+import cPickle as pickle
+import tempfile
+import random
+import os
+import time
+import sys
+
+try:
+    import numpy
+    from batch import BatchGame
+except ImportError:
+    numpy = None
+
+def generated_lines(cols, rows, seed=0, fill=0.6):
+    """Lines of a map file in the style of the default arena, at any size"""
+    rand = random.Random(seed)
+    lines = []
+    for y in xrange(rows):
+        line = []
+        for x in xrange(cols):
+            if x in (0, cols-1) or y in (0, rows-1) or (x % 2 == 0 and y % 2 == 0):
+                line.append('B')
+            elif (x, y) in ((1, 1), (cols-2, 1), (1, rows-2), (cols-2, rows-2)):
+                line.append('S')
+            elif x + y > 3 and rand.random() < fill:
+                line.append('.')
+            else:
+                line.append(' ')
+        lines.append(''.join(line))
+
+    return lines
+
+def timed(f, count):
+    """Seconds per call of f, over count calls"""
+    start = time.time()
+    for _ in xrange(count):
+        f()
+
+    return (time.time() - start) / count
+
+def bench_render(cols=501, rows=501, count=20):
+    """Full render against incremental render after a single player step"""
+    state = GameState()
+    state.arena_build(generated_lines(cols, rows))
+    p1 = Player()
+    state.player_add(p1)
+    state.spawn()
+    str(state)
+
+    moves = [Player.RIGHT, Player.LEFT]
+
+    def step():
+        state.action_add(p1, moves[0])
+        moves.reverse()
+        state._actions_process()
+
+    def full():
+        step()
+        state._render_full()
+
+    def incremental():
+        step()
+        str(state)
+
+    print "render %dx%d full:        %8.3fms" % (cols, rows, timed(full, count) * 1000)
+    print "render %dx%d incremental: %8.3fms" % (cols, rows, timed(incremental, count) * 1000)
+
+def deep_size(root, exclude=()):
+    """Bytes used by an object and everything it refers to, leaving out anything in exclude"""
+    seen = set(id(o) for o in exclude)
+    size = 0
+    stack = [root]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, (type, int, long, float, bool, basestring)) or o is None:
+            continue
+
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif not isinstance(o, array):
+            stack.extend(getattr(o, '__dict__', {}).values())
+            for cls in type(o).__mro__:
+                for slot in cls.__dict__.get('__slots__', ()):
+                    if hasattr(o, slot):
+                        stack.append(getattr(o, slot))
+
+    return size
+
+def crowd_game(cols, rows, players, seed=0, fill=0):
+    """
+    A game with a crowd of players spawned straight into a generated arena, and
+    a tick() that has them all wander and bomb, respawning any that have died:
+    (state, crowd, tick)
+    """
+    rand = random.Random(seed)
+    state = GameState(seed=seed, arena=None)
+    state.arena_build(generated_lines(cols, rows, fill=fill))
+    open_coords = sorted((x, y) for x, y, l in state.arena if not l)
+    crowd = []
+    for n, coords in enumerate(rand.sample(open_coords, players)):
+        p = Player()
+        p.spawn(n, state, coords)
+        crowd.append(p)
+
+    actions = [Player.UP, Player.DOWN, Player.LEFT, Player.RIGHT, Player.BOMB]
+
+    def tick():
+        for p in crowd:
+            if p.coords is None:
+                p.spawn(p.number, state, rand.choice(open_coords))
+            state.action_add(p, rand.choice(actions))
+        state.tick()
+
+    return state, crowd, tick
+
+def bench_tick(cols=61, rows=61, players=200, count=200, seed=0):
+    """A full game tick, with a crowd of players wandering and bombing an open arena"""
+    state, crowd, tick = crowd_game(cols, rows, players, seed)
+    print "tick %dx%d, %d players:   %8.3fms" % (cols, rows, players, timed(tick, count) * 1000)
+
+def bench_player_queue(count=10000, seed=0):
+    """Players joining, some leaving before they spawn, and the rest spawning"""
+    rand = random.Random(seed)
+    players = [Player() for _ in xrange(count)]
+    leavers = rand.sample(players, count // 2)
+
+    def lobby():
+        state = GameState()
+        for p in players:
+            state.player_add(p)
+            state.player_add(p) # joining twice is harmless
+        for p in leavers:
+            state.player_remove(p)
+        while state._player_queue:
+            state._player_queue.pop()
+
+    print "player queue, %d players:  %8.3fms" % (count, timed(lobby, 1) * 1000)
+
+def bench_memory(cols=501, rows=501):
+    """Memory used by the arena, per coord space"""
+    state = GameState()
+    state.arena_build(generated_lines(cols, rows))
+    size = deep_size(state.arena, exclude=[state])
+    print "memory %dx%d: %d bytes, %.1f bytes per coord space" % (cols, rows, size, float(size) / (cols*rows))
+
+def bench_batch(games=1000, players=4, ticks=100, seed=0):
+    """Many games on the default arena, batched against one GameState after another"""
+    if numpy is None:
+        print "batch: needs numpy"
+        return
+
+    lines = [line.rstrip() for line in open("arenas/default.bmm")]
+    rand = numpy.random.RandomState(seed)
+    moves = rand.randint(Player.UP, Player.BOMB + 1, size=(ticks, games, players))
+    actions = numpy.where(rand.random_sample(moves.shape) < 0.5, moves, 0)
+
+    def looped():
+        for g in xrange(games):
+            state = GameState(seed=g, arena=None)
+            state.arena_build(lines)
+            ps = [Player() for _ in xrange(players)]
+            for p in ps:
+                state.player_add(p)
+            state.spawn()
+            for tick in xrange(ticks):
+                for n, action in enumerate(actions[tick, g]):
+                    if action:
+                        state.action_add(ps[n], action)
+                state.tick()
+
+    def batched():
+        engine = BatchGame(lines, games, players)
+        for tick in xrange(ticks):
+            engine.step(actions[tick])
+
+    for name, f in (('looped', looped), ('batched', batched)):
+        seconds = timed(f, 1)
+        print "%s %d games, %d ticks: %8.3fms, %.0f game ticks per second" % (name, games, ticks, seconds * 1000, games * ticks / seconds)
+
+def bench_snapshot(cols=501, rows=501, players=200, ticks=20, count=5, seed=0):
+    """Snapshot and restore of a big game under way, against pickling it"""
+    state, crowd, tick = crowd_game(cols, rows, players, seed, fill=0.6)
+    for _ in xrange(ticks):
+        tick()
+
+    blob = state.snapshot(crowd)
+    pickled = pickle.dumps((state, crowd), pickle.HIGHEST_PROTOCOL)
+    print "snapshot %dx%d, %d players: %d bytes, pickled %d bytes" % (cols, rows, players, len(blob), len(pickled))
+    print "  snapshot: %8.3fms  pickle:   %8.3fms" % (timed(lambda: state.snapshot(crowd), count) * 1000,
+                                                     timed(lambda: pickle.dumps((state, crowd), pickle.HIGHEST_PROTOCOL), count) * 1000)
+    print "  restore:  %8.3fms  unpickle: %8.3fms" % (timed(lambda: GameState.restore(blob), count) * 1000,
+                                                     timed(lambda: pickle.loads(pickled), count) * 1000)
+
+def bench_seek(ticks=50000, seek=40000, keyframe_every=1000, seed=0):
+    """Seeking into a long game through keyframes, against playing it out from the start"""
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        state = GameState(seed=seed)
+        log = InputLog(hash_every=ticks)
+        state.record(log)
+        Headless(state, [Player() for _ in xrange(4)], random_bots(seed)).run(ticks)
+
+        replay = Replay.from_log(log)
+        writer = ReplayWriter(open(path, 'wb'), keyframe_every)
+        replay.state.record(writer)
+        replay.run()
+        writer.close()
+
+        reader = ReplayReader(path)
+        print "seek to %d of %d ticks, keyframes every %d (%d bytes):" % (seek, ticks, keyframe_every, os.path.getsize(path))
+        print "  from the start: %8.3fms" % (timed(lambda: Replay.from_log(log, check=False).run(seek), 1) * 1000)
+        print "  from keyframes: %8.3fms" % (timed(lambda: reader.seek(seek), 10) * 1000)
+        reader.close()
+    finally:
+        os.remove(path)
+
+def bench_crash_log(cols=201, rows=201, players=200, count=256, ticks=64, seed=0):
+    """Keeping what a crash report needs each tick: a crash log, against copying the game before every tick"""
+    state, crowd, tick = crowd_game(cols, rows, players, seed)
+
+    def copying():
+        last_state, last_arena = str(state), state.arena.data[:]
+        tick()
+
+    print "crash reporting %dx%d, %d players, per tick:" % (cols, rows, players)
+    print "  none:          %8.3fms" % (timed(tick, count) * 1000)
+    print "  copying:       %8.3fms" % (timed(copying, count) * 1000)
+    crash = CrashLog(ticks)
+    state.record(crash)
+    print "  crash log:     %8.3fms" % (timed(tick, count) * 1000)
+    print "  on a crash:    %8.3fms" % (timed(lambda: crash.last_state(state.now), 5) * 1000)
+
+def bench_metrics(cols=61, rows=61, players=200, count=500, seed=0):
+    """A full game tick with its phases timed for metrics, against without"""
+    state, crowd, tick = crowd_game(cols, rows, players, seed)
+
+    metrics = TickMetrics(state)
+    print "metrics %dx%d, %d players, per tick:" % (cols, rows, players)
+    print "  detached:      %8.3fms" % (timed(tick, count) * 1000)
+    metrics.attach()
+    print "  attached:      %8.3fms" % (timed(tick, count) * 1000)
+    print "  report:        %8.3fms" % (timed(metrics.report, count) * 1000)
+    print "  prometheus:    %8.3fms" % (timed(metrics.prometheus, count) * 1000)
+
+if __name__ == '__main__':
+    bench_render()
+    bench_tick()
+    bench_player_queue()
+    bench_memory()
+    bench_batch()
+    bench_snapshot()
+    bench_seek()
+    bench_crash_log()
+    bench_metrics()
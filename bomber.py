@@ -3,11 +3,28 @@
 
 from collections import deque
 from udeque import udeque
-from arena import Arena
+from wheel import TimingWheel
+from arena import IndexedArena
+from operator import attrgetter
+from array import array
+import struct
+import json
+import zlib
+import sys
 import os
 import random
 import codecs
 
+_zindex = attrgetter('ZINDEX')
+
+# coord modifiers for up, down, left, right
+DIRECTIONS = (0, -1), (0, +1), (-1, 0), (+1, 0)
+
+# the arms of a flame, a bit for each of the DIRECTIONS
+ARM_UP, ARM_DOWN, ARM_LEFT, ARM_RIGHT = (1 << d for d in xrange(len(DIRECTIONS)))
+ARMS_VT = ARM_UP | ARM_DOWN
+ARMS_HZ = ARM_LEFT | ARM_RIGHT
+
 class GameObject(object):
 
     """
@@ -15,6 +32,8 @@ class GameObject(object):
     Mostly populated with debugging helpers
     """
 
+    __slots__ = ('state', 'coords')
+
     DEBUG_CHR = ' '
     ZINDEX = 0
 
@@ -30,7 +49,7 @@ class GameObject(object):
 
     def remove(self):
         """Lots of game objects need to remove themselves, so it's centralised here"""
-        self.state.arena.coords_remove(self.coords, self)
+        self.state.arena.remove(self)
 
     def __repr__(self):
         try:
@@ -38,17 +57,51 @@ class GameObject(object):
         except AttributeError:
             return '<%s %s 0x%x>' % (self.__class__.__name__, str(self.coords), id(self))
 
-class Block(GameObject):
+class Terrain(GameObject):
+
+    """
+    Base class for objects that never move; the arena keeps only a code per
+    coord space for these, handing out copies of the first one it was given
+    """
+
+    __slots__ = ()
+
+    def at(self, coords):
+        """A copy of this object at a set of coords"""
+        obj = object.__new__(type(self))
+        obj.state = self.state
+        obj.coords = coords
+        return obj
 
-    """The indestructible block"""
+    def __eq__(self, other):
+        """Copies are interchangeable, so compare by class and coords"""
+        return type(self) is type(other) and self.coords == other.coords
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self), self.coords))
+
+class Block(Terrain):
+
+    """The indestructible block; one is shared by every coord space it occupies, so it has no coords"""
+
+    __slots__ = ()
 
     DEBUG_CHR = 'B'
     ZINDEX = 1
 
+    def at(self, _):
+        """There's only the one Block"""
+        return self
+
 class Powerup(GameObject):
 
     """Base class for powerups"""
 
+    __slots__ = ()
+
     ZINDEX = 1
 
     def flamed(self, _):
@@ -59,30 +112,38 @@ class PowerupFlame(Powerup):
 
     """Longer flames!"""
 
+    __slots__ = ()
+
     DEBUG_CHR = 'f'
     ZINDEX = 1
 
     def picked_up(self, player):
         """When picked up by a player, increased that player's powerup stats"""
         player.flame += 1
+        self.state.pickups += 1
         self.remove()
 
 class PowerupBomb(Powerup):
 
     """More bombs!"""
 
+    __slots__ = ()
+
     DEBUG_CHR = 'b'
     ZINDEX = 1
 
     def picked_up(self, player):
         """When picked up by a player, increased that player's powerup stats"""
         player.bomb += 1
+        self.state.pickups += 1
         self.remove()
 
-class DestructibleBlock(GameObject):
+class DestructibleBlock(Terrain):
 
     """The destructible block"""
 
+    __slots__ = ()
+
     DEBUG_CHR = '.'
     ZINDEX = 1
 
@@ -90,16 +151,18 @@ class DestructibleBlock(GameObject):
         """What to do when I get flamed; remove self, spawn a powerup (maybe)"""
         self.remove()
 
-        rand = random.random()
+        rand = self.state.random.random()
         if   0.00 <= rand < 0.15:
             PowerupFlame(state=self.state, coords=self.coords)
         elif 0.15 <= rand < 0.30:
             PowerupBomb(state=self.state, coords=self.coords)
 
-class SpawnPoint(GameObject):
+class SpawnPoint(Terrain):
 
     """Starting point for spawned players"""
 
+    __slots__ = ()
+
     DEBUG_CHR = 'S'
     ZINDEX = 1
 
@@ -115,6 +178,8 @@ class Player(GameObject):
 
     """Represent a player"""
 
+    __slots__ = ('_bombs_live', 'number', 'flame', 'bomb', 'kills', 'deaths', 'suicides', 'name')
+
     DEBUG_CHR = 'P'
     ZINDEX = 3
 
@@ -124,6 +189,7 @@ class Player(GameObject):
     LEFT  = 3
     RIGHT = 4
     BOMB  = 5
+    ACTIONS = frozenset((UP, DOWN, LEFT, RIGHT, BOMB))
 
     def __init__(self, *args, **kwargs):
         """Set up some defaults"""
@@ -148,6 +214,12 @@ class Player(GameObject):
         """Do our (delayed) init"""
         self.number = number
         super(Player, self).__init__(state=state, coords=coords)
+        state._alive.append(self)
+
+    def remove(self):
+        """Leave the arena, and so the players the game state ticks"""
+        super(Player, self).remove()
+        self.state._player_gone(self)
 
     def __str__(self):
         """Output debug information"""
@@ -179,18 +251,19 @@ class Player(GameObject):
 
     def move(self, new_coords):
         """Move a player"""
-        objs = []
-        for o in self.state.arena.coords_get(new_coords):
-            if isinstance(o, (Block, DestructibleBlock, Bomb)):
-                raise IndexError("Can't move %r to %r" % (self, new_coords))
+        arena = self.state.arena
+        if not arena.passable(new_coords):
+            raise IndexError("Can't move %r to %r" % (self, new_coords))
 
-            objs.append(o)
-
-        self.remove()
-        self.state.arena.coords_add(new_coords, self)
+        arena.move(self, new_coords)
         self.coords = new_coords
-        for o in objs:
-            o.picked_up(self)
+        self.state.moves += 1
+        if not arena.coords_have_mask(new_coords, arena.mask_for(Powerup, Flame)):
+            return # nothing else there does anything when picked up
+
+        for o in arena.coords_get(new_coords):
+            if o is not self:
+                o.picked_up(self)
 
     def picked_up(self, player):
         """Picked up by another player? Nah"""
@@ -200,80 +273,81 @@ class Bomb(GameObject):
 
     """Boom!"""
 
+    __slots__ = ('player', 'original_owner', 'flame', 'exploded', 'fuse')
+
     DEBUG_CHR = 'x'
     ZINDEX = 2
 
+    FUSE = 4
+
     def __init__(self, player):
         """Set up some defaults and references"""
         player._bombs_live.append(self)
         self.player = player
         self.original_owner = player # exists for cases where the bomb changes owner, e.g. when flamed by another player
         self.flame = player.flame
-        self.ticks_left = 4
+        self.exploded = False
         super(Bomb, self).__init__(player.state, player.coords)
+        self.fuse = self.state._bomb_wheel.schedule(self.FUSE, self) # the bomb tick we explode on
 
     def _more_repr(self):
         return "op:%r, p:%r, f:%r, t:%r" % (self.original_owner, self.player, self.flame, self.ticks_left)
 
+    @property
+    def ticks_left(self):
+        """Bomb ticks until we explode"""
+        return self.fuse - self.state._bomb_wheel.now
+
     def tick(self):
-        """What to do when the game ticks; count down and explode"""
-        self.ticks_left -= 1
+        """Tick this bomb on its own, ahead of the game; count down and explode"""
+        self.fuse -= 1
 
         if self.ticks_left > 0:
+            self.state._bomb_wheel.schedule(self.ticks_left, self)
             return
 
         self.explode()
 
     def explode(self):
-        """Probably the most important method in the game"""
+        """Probably the most important method in the game; queue our explosion"""
+        self.exploded = True
+        self.state._blast(self.burst)
+
+    def burst(self):
+        """Flame our coords and send the flames out in each direction, as far as the Blocks allow"""
         self.remove()
-        FlameCross(self, self.coords)
-        self.incinerate(self.coords, (0, -1), self.flame)
-        self.incinerate(self.coords, (0, +1), self.flame)
-        self.incinerate(self.coords, (-1, 0), self.flame)
-        self.incinerate(self.coords, (+1, 0), self.flame)
-
-    def incinerate(self, coords, coord_mod, flame):
-        """Recursive function to spread the flames"""
+        self.state.explosions += 1
+        # the work queue is a stack: queue up the last direction first
+        for direction in reversed(xrange(len(DIRECTIONS))):
+            reach = min(self.flame, self.state.reach(self.coords, direction))
+            if reach:
+                self.state._blast(self.incinerate, self.coords, direction, self.flame, reach)
+
+        Flame.ignite(self, self.coords, ARMS_VT | ARMS_HZ)
+
+    def incinerate(self, coords, direction, flame, reach):
+        """Spread the flames a step, queueing the next step while within reach"""
+        coord_mod = DIRECTIONS[direction]
         coords = coords[0] + coord_mod[0], coords[1] + coord_mod[1]
-        try:
-            self.state.arena.sanity(coords)
-        except (IndexError):
-            return
-
-        if self.state.arena.coords_have_class(coords, Block):
-            return
+        arm = 1 << direction
 
         # keep note if we have a DestructibleBlock, as it'll removed itself before we check on it
         destructible = self.state.arena.coords_have_class(coords, DestructibleBlock)
 
         if flame > 1 and not destructible:
-            if coord_mod == (0, -1) or coord_mod == (0, +1):
-                FlameVt(self, coords)
-            if coord_mod == (-1, 0) or coord_mod == (+1, 0):
-                FlameHz(self, coords)
-        else:
-            if coord_mod == (0, -1):
-                FlameEndUp(self, coords)
-            if coord_mod == (0, +1):
-                FlameEndDown(self, coords)
-            if coord_mod == (-1, 0):
-                FlameEndLeft(self, coords)
-            if coord_mod == (+1, 0):
-                FlameEndRight(self, coords)
-
-        if destructible:
-            return
-
-        if flame == 1:
-            return
+            if reach > 1:
+                # queued before flaming the coords, so any bombs set off there are resolved first
+                self.state._blast(self.incinerate, coords, direction, flame-1, reach-1)
 
-        self.incinerate(coords,
-                        coord_mod,
-                        flame-1)
+            Flame.ignite(self, coords, ARMS_VT if arm & ARMS_VT else ARMS_HZ)
+        else:
+            Flame.ignite(self, coords, arm)
 
     def flamed(self, flame):
         """What to do when I get flamed; become property of flamer and explode"""
+        if self.exploded:
+            return
+
         self.player = flame.bomb.player
         self.explode()
 
@@ -283,20 +357,61 @@ class Bomb(GameObject):
 
 class Flame(GameObject):
 
-    """Crackle"""
+    """
+    Crackle; a flame has an arm in each direction it spreads, and there's only
+    ever one per coord space: flames that overlap are merged by adding arms,
+    the class (and so the glyph) following from the arms by FLAME_KINDS. Flames
+    are made through ignite(), which spreads any flame already there instead
+    """
+
+    __slots__ = ('bomb', 'burning', 'arms')
 
     DEBUG_CHR = "~"
     ZINDEX = 4
 
+    ARMS = 0
+
     def __init__(self, bomb, coords):
         """Set up some defaults and references"""
         self.bomb = bomb
+        self.burning = True
+        self.arms = self.ARMS
         super(Flame, self).__init__(bomb.state, coords)
-
-        self.state._flames.append(self)
-
-        for o in self.state.arena.coords_get(coords):
-            if o != self:
+        self.state.flames_made += 1
+
+        self.state._flame_wheel.schedule(1, self)
+        self._burn()
+
+    @staticmethod
+    def ignite(bomb, coords, arms):
+        """Set coords alight, merging with any flame already there rather than making another"""
+        arena = bomb.state.arena
+        if arena.coords_have_class(coords, Flame):
+            for o in arena.coords_get(coords):
+                if isinstance(o, Flame):
+                    o.spread(arms)
+                    return o
+
+        return FLAME_KINDS[arms](bomb, coords)
+
+    def spread(self, arms):
+        """Add arms, when another flame reaches our coords, and flame the coords again"""
+        self._arms_add(arms)
+        self._burn()
+
+    def _arms_add(self, arms):
+        """Add arms, becoming the kind of flame that has them all"""
+        arms |= self.arms
+        if arms != self.arms:
+            self.arms = arms
+            self.__class__ = FLAME_KINDS[arms]
+            self.state.arena.coords_touch(self.coords)
+
+    def _burn(self):
+        """Flame everything else at our coords"""
+        for o in self.state.arena.coords_get(self.coords):
+            # flaming one object may remove others
+            if o is not self and self.state.arena.coords_have_obj(self.coords, o):
                 o.flamed(self)
 
     def _more_repr(self):
@@ -306,128 +421,152 @@ class Flame(GameObject):
         """What to do when the game ticks; remove self"""
         self.remove()
 
-    def flamed(self, flame):
-        """Turn into other type of flame"""
-        flame.remove()
-
-        if self.__class__ is flame.__class__ or self.__class__ is FlameCross:
-            return
-
-        self.remove()
-
-        self.combine(flame.__class__)(self.bomb, self.coords)
-
-    @classmethod
-    def combine(cls, _):
-        return Flame
-
     def picked_up(self, player):
         """What to do when a player picks us up?; flame 'em"""
         player.flamed(self)
 
     def remove(self):
-        self.state._flames.remove(self)
+        self.burning = False
         super(Flame, self).remove()
 
 class FlameCross(Flame):
 
     """Horizonal/Vertical flame"""
 
-    DEBUG_CHR = "+"
+    __slots__ = ()
 
-    @classmethod
-    def combine(cls, _):
-        return FlameCross
+    DEBUG_CHR = "+"
+    ARMS = ARMS_VT | ARMS_HZ
 
 class FlameHz(Flame):
 
     """Horizonal flame"""
 
-    DEBUG_CHR = "-"
+    __slots__ = ()
 
-    @classmethod
-    def combine(cls, flamecls):
-        if flamecls in (FlameEndRight, FlameEndLeft):
-            return FlameHz
-        else:
-            return FlameCross
+    DEBUG_CHR = "-"
+    ARMS = ARMS_HZ
 
 class FlameVt(Flame):
 
     """Vertical flame"""
 
-    DEBUG_CHR = "|"
+    __slots__ = ()
 
-    @classmethod
-    def combine(cls, flamecls):
-        if flamecls in (FlameEndUp, FlameEndDown):
-            return FlameVt
-        else:
-            return FlameCross
+    DEBUG_CHR = "|"
+    ARMS = ARMS_VT
 
 class FlameEndUp(Flame):
 
     """Flame endpoint"""
 
-    DEBUG_CHR = "^"
+    __slots__ = ()
 
-    @classmethod
-    def combine(cls, flamecls):
-        if flamecls in (FlameVt, FlameEndDown):
-            return FlameVt
-        else:
-            return FlameCross
+    DEBUG_CHR = "^"
+    ARMS = ARM_UP
 
 class FlameEndDown(Flame):
 
     """Flame endpoint"""
 
-    DEBUG_CHR = "v"
+    __slots__ = ()
 
-    @classmethod
-    def combine(cls, flamecls):
-        if flamecls in (FlameVt, FlameEndUp):
-            return FlameVt
-        else:
-            return FlameCross
+    DEBUG_CHR = "v"
+    ARMS = ARM_DOWN
 
 class FlameEndLeft(Flame):
 
     """Flame endpoint"""
 
-    DEBUG_CHR = "<"
+    __slots__ = ()
 
-    @classmethod
-    def combine(cls, flamecls):
-        if flamecls in (FlameHz, FlameEndRight):
-            return FlameHz
-        else:
-            return FlameCross
+    DEBUG_CHR = "<"
+    ARMS = ARM_LEFT
 
 class FlameEndRight(Flame):
 
     """Flame endpoint"""
 
+    __slots__ = ()
+
     DEBUG_CHR = ">"
+    ARMS = ARM_RIGHT
 
-    @classmethod
-    def combine(cls, flamecls):
-        if flamecls in (FlameHz, FlameEndLeft):
-            return FlameHz
-        else:
-            return FlameCross
+def _flame_kind(arms):
+    """The class of flame with the given arms: arms both across and along make a cross"""
+    if arms & ARMS_VT and arms & ARMS_HZ:
+        return FlameCross
+
+    for cls in (Flame, FlameHz, FlameVt, FlameEndUp, FlameEndDown, FlameEndLeft, FlameEndRight):
+        if cls.ARMS == arms:
+            return cls
+
+# the class of flame for each combination of arms
+FLAME_KINDS = tuple(_flame_kind(arms) for arms in xrange((ARMS_VT | ARMS_HZ) + 1))
+
+# snapshots: a header, then sections each prefixed by their length
+SNAPSHOT_MAGIC = 'BOMBSNAP'
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('<8sH') # magic, format version
+_SECTION = struct.Struct('<I')
+
+# the kinds of object a snapshot keeps in the arena
+_SNAP_PLAYER, _SNAP_BOMB, _SNAP_FLAME, _SNAP_POWERUP_FLAME, _SNAP_POWERUP_BOMB = xrange(5)
+
+def _ints(data, typecode='i', swap=False):
+    """An array from a snapshot section"""
+    a = array(typecode, data)
+    if swap:
+        a.byteswap()
+    return a
 
 class GameState(object):
 
     """Represents the game state"""
 
-    def __init__(self):
-        """Simple init of variables"""
+    # coord modifiers for the movement actions
+    _moves = {
+        Player.UP: DIRECTIONS[0],
+        Player.DOWN: DIRECTIONS[1],
+        Player.LEFT: DIRECTIONS[2],
+        Player.RIGHT: DIRECTIONS[3],
+    }
+
+    def __init__(self, seed=None, arena=("arenas", "default.bmm")):
+        """
+        Simple init of variables; games with the same seed and inputs play out
+        the same. The arena is a map file to load, or None to build one later
+        """
+        if seed is None:
+            seed = random.randrange(1 << 32)
+        self.seed = seed
+        self.random = random.Random(seed) # for anything left to chance, such as powerups
+
+        self.now = 0 # ticks so far
+        self.every = (1, 1, 1) # flames, actions and bombs are processed on ticks that are multiples of these
+        self.logs = [] # input logs, such as InputLog, recording the game
+
+        # running counts of what happens, for metrics; they're not part of the game, so not snapshotted
+        self.explosions = 0
+        self.flames_made = 0
+        self.moves = 0
+        self.pickups = 0
+
         self.arena = None
+        self._arena_lines = None
+        self._version_base = 0
+        self._glyphs = None
+        self._frame = None
+        self._frame_version = None
+        self._frame_deltas = deque(maxlen=64) # (from version, to version, [(position, character), ...])
 
         self._player_queue = udeque()
+        self._alive = udeque() # players in the arena, in the order they spawned
         self._sticky_actions = {}
-        self._action_queue = deque()
+        self._action_queues = {} # player -> deque of (sequence number, action), for players with actions queued
+        self._action_seq = 0
+        self.action_queue_max = 32 # actions queued per player; the oldest are dropped beyond this
+        self.action_coalesce = False # queue only a player's latest movement and a single bomb
 
         self._lookup = {
             'B': Block,
@@ -435,9 +574,23 @@ class GameState(object):
             'S': SpawnPoint,
         }
 
-        self._flames = []
+        # classes the arena keeps a per-coords bitmask of
+        self._indexed = (Block, DestructibleBlock, Bomb, Flame, Player, Powerup, SpawnPoint)
+        # ...and those it keeps the coords of; terrain never moves, and only SpawnPoints are looked for
+        self._located = (Bomb, Flame, Player, Powerup, SpawnPoint)
+        # ...and those it keeps as a code per coord space rather than as objects
+        self._terrain = (Block, DestructibleBlock, SpawnPoint)
+        # ...and those that players can't move onto
+        self._blocking = (Block, DestructibleBlock, Bomb)
+
+        self._bomb_wheel = TimingWheel() # bombs by the bomb tick they explode on
+        self._flame_wheel = TimingWheel() # flames by the flame tick they burn out on
 
-        self.arena_load(["arenas", "default.bmm"])
+        self._blasts = [] # explosion work: a stack of (function, args)
+        self._blasting = False
+
+        if arena is not None:
+            self.arena_load(list(arena))
 
     def arena_load(self, filename_list):
         """Load an arena from a file"""
@@ -447,16 +600,82 @@ class GameState(object):
             for line in fp:
                 lines.append(line.rstrip())
 
-        self.arena = Arena(max((len(line) for line in lines)), len(lines))
+        self.arena_build(lines)
+
+    def arena_build(self, lines):
+        """Build an arena from lines in the same format as the map files"""
+        if self.arena is not None:
+            # keep the version increasing across arenas
+            self._version_base = self.version + 1
+
+        self._arena_lines = list(lines)
+        self.arena = IndexedArena(max((len(line) for line in lines)), len(lines), self._indexed, self._located, self._terrain, self._blocking)
+        self._glyphs = None
+
+        # Blocks are identical and never move, so one does for the whole arena
+        block = Block(state=None, coords=None)
+        block.state = self
 
         for row, line in enumerate(lines):
             for col, char in enumerate(line):
                 if char == ' ':
                     continue
 
-                self._lookup[char](state=self, coords=(col, row))
-
-    def __str__(self):
+                if self._lookup[char] is Block:
+                    self.arena.coords_add((col, row), block)
+                else:
+                    self._lookup[char](state=self, coords=(col, row))
+
+        # a new arena is rendered in full, so there's no need to track what changed in building it
+        self.arena.take_dirty()
+        self._reach_build()
+
+    def _reach_build(self):
+        """
+        Work out, for each coord space and direction, how far a flame can travel
+        before it hits a Block or the edge of the arena; Blocks never move, so
+        this holds for the life of the arena
+        """
+        arena = self.arena
+        cols, rows = arena.cols, arena.rows
+        masks = arena.masks
+        wall = arena.bits[Block]
+        n = len(DIRECTIONS)
+        up, down, left, right = xrange(n)
+        reach = array('H', [0]) * (cols*rows*n)
+
+        # up and left build on the coords above/left of us, down and right on those below/right
+        for i in xrange(cols*rows):
+            x, y = i % cols, i // cols
+            if y > 0 and not masks[i-cols] & wall:
+                reach[i*n+up] = min(reach[(i-cols)*n+up] + 1, 0xffff)
+            if x > 0 and not masks[i-1] & wall:
+                reach[i*n+left] = min(reach[(i-1)*n+left] + 1, 0xffff)
+
+        for i in reversed(xrange(cols*rows)):
+            x, y = i % cols, i // cols
+            if y < rows-1 and not masks[i+cols] & wall:
+                reach[i*n+down] = min(reach[(i+cols)*n+down] + 1, 0xffff)
+            if x < cols-1 and not masks[i+1] & wall:
+                reach[i*n+right] = min(reach[(i+1)*n+right] + 1, 0xffff)
+
+        self._reach = reach
+
+    def reach(self, coords, direction):
+        """How far a flame can travel from coords in a direction (an index into DIRECTIONS)"""
+        return self._reach[self.arena.coords_index(coords)*len(DIRECTIONS) + direction]
+
+    @property
+    def version(self):
+        """Monotonically increasing version of the game state, bumped on every change to the arena"""
+        return self._version_base + self.arena.version
+
+    @staticmethod
+    def _glyph(l):
+        """The character to show for a list of objects: that of the one on top"""
+        return str(max(l, key=_zindex)) if l else GameObject.DEBUG_CHR
+
+    def _render_full(self):
         """Produce a string representation of the arena in the same format as the map files"""
         chars = []
         old_y = 0
@@ -465,90 +684,474 @@ class GameState(object):
                 chars.append('\n')
                 old_y = y
 
-            chars.append(str(max(l + [GameObject(state=None, coords=None)],
-                                 key=lambda o: o.ZINDEX)))
+            chars.append(self._glyph(l))
 
         chars.append('\n')
 
         return ''.join(chars)
 
+    def _render(self):
+        """Bring the glyph buffer up to date, redrawing only the coord spaces changed since the last render"""
+        dirty = self.arena.take_dirty()
+        if self._glyphs is None:
+            self._glyphs = bytearray(self._render_full())
+            self._frame_deltas.clear()
+            return
+
+        cols = self.arena.cols
+        index_get = self.arena.index_get
+        glyphs = self._glyphs
+        changes = []
+        for i in dirty:
+            # each row is followed by a newline
+            pos = i + i // cols
+            c = ord(self._glyph(index_get(i)))
+            if glyphs[pos] != c:
+                glyphs[pos] = c
+                changes.append((pos, chr(c)))
+
+        self._frame_deltas.append((self._frame_version, self.version, changes))
+
+    def __str__(self):
+        """The rendered arena, cached per version so that repeat calls are free"""
+        version = self.version
+        if self._frame_version != version:
+            self._render()
+            self._frame = str(self._glyphs)
+            self._frame_version = version
+
+        return self._frame
+
+    def frame_delta(self, since):
+        """
+        The changes to the rendered arena since the given version as sorted
+        (position, character) pairs, or None if they are no longer known
+        """
+        str(self) # bring the frame up to date
+        if since == self._frame_version:
+            return []
+
+        changes = None
+        for old, new, cells in self._frame_deltas:
+            if old == since:
+                changes = {}
+
+            if changes is not None:
+                changes.update(cells)
+
+        if changes is None:
+            return None
+
+        return sorted(changes.items())
+
     def __repr__(self):
         return str(self)
 
     def player_add(self, player):
         """Add a player to the game state"""
+        for log in self.logs:
+            log.add(self.now, player, log.JOIN)
         self._player_queue.appendleft(player)
 
     def player_remove(self, player):
-        """Remove a player from the game state"""
-        player.remove()
+        """Remove a player from the game state, whether they're waiting to spawn or in the arena"""
+        for log in self.logs:
+            log.add(self.now, player, log.LEAVE)
+        self._player_queue.discard(player)
+        self._action_queues.pop(player, None)
+        if player in self._alive:
+            player.remove()
 
     def spawn(self):
         """Spawn the players into the arena"""
+        for log in self.logs:
+            log.add(self.now, None, log.SPAWN)
         p_no = 0
-        for x, y, _ in self.arena:
-            if self.arena.coords_have_class((x, y), SpawnPoint):
-                try:
-                    player = self._player_queue.pop()
-                except (IndexError):
-                    break
-
-                p_no += 1
-                player.spawn(p_no, state=self, coords=(x, y))
-                self._sticky_actions[player] = None
+        # spawn in reading order, as the map files are laid out
+        for x, y in sorted(self.arena.class_coords(SpawnPoint), key=lambda c: (c[1], c[0])):
+            try:
+                player = self._player_queue.pop()
+            except (IndexError):
+                break
+
+            p_no += 1
+            player.spawn(p_no, state=self, coords=(x, y))
+            self._sticky_actions[player] = None
 
     def tick(self, count=1):
-        """Step to the next game state: this is an example and is used for testing"""
+        """Step to the next game state, processing whichever phases are due"""
+        flames, actions, bombs = self.every
         for _ in xrange(count):
-            self._flames_process()
-            self._actions_process()
-            self._bombs_process()
+            if self.now % flames == 0:
+                self._flames_process()
+            if self.now % actions == 0:
+                self._actions_process()
+            if self.now % bombs == 0:
+                self._bombs_process()
+
+            self.now += 1
+            for log in self.logs:
+                log.ticked(self)
+
+    def record(self, log):
+        """Log the inputs to the game from now on, so that it can be replayed"""
+        log.start(self)
+        self.logs.append(log)
+
+    def players_known(self, players=()):
+        """The players given, followed by any others that the game refers to"""
+        known = list(players)
+        seen = set(known)
+
+        def see(player):
+            if player not in seen:
+                seen.add(player)
+                known.append(player)
+
+        queues = self._action_queues
+        for p in self._player_queue:
+            see(p)
+        for p in self._alive:
+            see(p)
+        for p in sorted(queues, key=lambda p: queues[p][0][0]):
+            see(p)
+        for i in sorted(self.arena.entities):
+            for o in self.arena.entities[i]:
+                bomb = o.bomb if isinstance(o, Flame) else o
+                if isinstance(bomb, Bomb):
+                    see(bomb.original_owner)
+                    see(bomb.player)
+
+        return known
+
+    def snapshot(self, players=()):
+        """
+        The whole game as a compact binary string, to restore() it from; the
+        players given come first in the snapshot's table of players, so they
+        can be matched up afterwards, followed by any others the game refers to
+        """
+        if self._blasts:
+            raise ValueError("Can't snapshot in the middle of a tick")
+
+        arena = self.arena
+        players = self.players_known(players)
+        player_index = dict((p, n) for n, p in enumerate(players))
+
+        # bombs in the arena, in the order their owners dropped them, then any that flames remember
+        bombs = [b for p in players for b in p._bombs_live]
+        live = len(bombs)
+        bomb_index = dict((b, n) for n, b in enumerate(bombs))
+        flames = []
+        flame_index = {}
+
+        entities = array('i')
+        for i in sorted(arena.entities):
+            for o in arena.entities[i]:
+                if isinstance(o, Player):
+                    kind, ref = _SNAP_PLAYER, player_index[o]
+                elif isinstance(o, Bomb):
+                    kind, ref = _SNAP_BOMB, bomb_index[o]
+                elif isinstance(o, Flame):
+                    if o.bomb not in bomb_index:
+                        bomb_index[o.bomb] = len(bombs)
+                        bombs.append(o.bomb)
+                    kind, ref = _SNAP_FLAME, len(flames)
+                    flame_index[o] = ref
+                    flames.append(o)
+                elif isinstance(o, PowerupFlame):
+                    kind, ref = _SNAP_POWERUP_FLAME, 0
+                elif isinstance(o, PowerupBomb):
+                    kind, ref = _SNAP_POWERUP_BOMB, 0
+                else:
+                    raise TypeError("Can't snapshot %r" % o)
+                entities.extend((i, kind, ref))
+
+        player_data = array('i')
+        for p in players:
+            x, y = p.coords if p.coords is not None else (-1, -1)
+            player_data.extend((p.state is not None, -1 if p.number is None else p.number,
+                                p.flame, p.bomb, p.kills, p.deaths, p.suicides, x, y))
+
+        bomb_data = array('i')
+        for b in bombs:
+            bomb_data.extend((player_index[b.original_owner], player_index[b.player], b.flame, b.exploded, b.fuse) + b.coords)
+
+        flame_data = array('i')
+        for f in flames:
+            flame_data.extend((f.arms, bomb_index[f.bomb]))
+
+        # only what's still due off the wheels; the rest would be skipped anyway
+        bomb_wheel = array('i')
+        for tick in sorted(self._bomb_wheel.slots):
+            for b in self._bomb_wheel.slots[tick]:
+                if b in bomb_index and not b.exploded:
+                    bomb_wheel.extend((tick, bomb_index[b]))
+
+        flame_wheel = array('i')
+        for tick in sorted(self._flame_wheel.slots):
+            for f in self._flame_wheel.slots[tick]:
+                if f in flame_index:
+                    flame_wheel.extend((tick, flame_index[f]))
+
+        action_queues = array('i')
+        queues = self._action_queues
+        for p in sorted(queues, key=lambda p: queues[p][0][0]):
+            queue = queues[p]
+            action_queues.extend((player_index[p], -1 if queue.maxlen is None else queue.maxlen, len(queue)))
+            for entry in queue:
+                action_queues.extend(entry)
+
+        rng_version, rng_words, rng_gauss = self.random.getstate()
+        sticky = self._sticky_actions
+        meta = dict(byteorder=sys.byteorder,
+                    seed=self.seed,
+                    now=self.now,
+                    every=self.every,
+                    action_queue_max=self.action_queue_max,
+                    action_coalesce=self.action_coalesce,
+                    action_seq=self._action_seq,
+                    version_base=self._version_base,
+                    arena_version=arena.version,
+                    cols=arena.cols,
+                    rows=arena.rows,
+                    terrain=[c.__name__ for c in self._terrain],
+                    bomb_now=self._bomb_wheel.now,
+                    flame_now=self._flame_wheel.now,
+                    rng=(rng_version, rng_gauss),
+                    names=[p.name for p in players],
+                    live=live,
+                    queue=[player_index[p] for p in self._player_queue],
+                    alive=[player_index[p] for p in self._alive],
+                    sticky=sorted((player_index[p], a) for p, a in sticky.iteritems()))
+
+        sections = (json.dumps(meta),
+                    array('I', rng_words).tostring(),
+                    zlib.compress(arena.terrain.tostring(), 1),
+                    zlib.compress(self._reach.tostring(), 1),
+                    player_data.tostring(),
+                    bomb_data.tostring(),
+                    flame_data.tostring(),
+                    entities.tostring(),
+                    bomb_wheel.tostring(),
+                    flame_wheel.tostring(),
+                    action_queues.tostring())
+
+        return _SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION) + \
+            ''.join(_SECTION.pack(len(section)) + section for section in sections)
+
+    @classmethod
+    def restore(cls, blob):
+        """
+        A game from a snapshot, ready to carry on from the tick it was taken
+        after, with its table of players: (state, players)
+        """
+        magic, version = _SNAPSHOT_HEADER.unpack_from(blob)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("Not a snapshot that can be restored: %r, version %r" % (magic, version))
+
+        sections = []
+        offset = _SNAPSHOT_HEADER.size
+        while offset < len(blob):
+            length, = _SECTION.unpack_from(blob, offset)
+            offset += _SECTION.size
+            sections.append(blob[offset:offset+length])
+            offset += length
+
+        meta, rng_words, terrain, reach, player_data, bomb_data, flame_data, entities, bomb_wheel, flame_wheel, action_queues = sections
+        meta = json.loads(meta)
+        swap = meta['byteorder'] != sys.byteorder
+
+        state = cls(seed=meta['seed'], arena=None)
+        if [c.__name__ for c in state._terrain] != meta['terrain']:
+            raise ValueError("Snapshot has different terrain: %r" % meta['terrain'])
+
+        rng_version, rng_gauss = meta['rng']
+        state.random.setstate((rng_version, tuple(_ints(rng_words, 'I', swap)), rng_gauss))
+        state.now = meta['now']
+        state.every = tuple(meta['every'])
+        state.action_queue_max = meta['action_queue_max']
+        state.action_coalesce = meta['action_coalesce']
+        state._action_seq = meta['action_seq']
+
+        # the terrain all at once, then the rest object by object
+        arena = state.arena = IndexedArena(meta['cols'], meta['rows'], state._indexed, state._located, state._terrain, state._blocking)
+        protos = {}
+        for code, terrain_cls in enumerate(arena.terrain_classes):
+            if terrain_cls is not None:
+                protos[code] = terrain_cls(state=None, coords=None)
+                protos[code].state = state
+        arena.terrain_load(zlib.decompress(terrain), protos)
+        state._reach = _ints(zlib.decompress(reach), 'H', swap)
+
+        players = []
+        fields = _ints(player_data, swap=swap)
+        for n in xrange(0, len(fields), 9):
+            in_game, number, flame, bomb, kills, deaths, suicides, x, y = fields[n:n+9]
+            p = Player()
+            p.state = state if in_game else None
+            p.number = None if number == -1 else number
+            p.flame, p.bomb, p.kills, p.deaths, p.suicides = flame, bomb, kills, deaths, suicides
+            p.coords = None if x == -1 else (x, y)
+            p.name = meta['names'][len(players)]
+            players.append(p)
+
+        bombs = []
+        fields = _ints(bomb_data, swap=swap)
+        for n in xrange(0, len(fields), 7):
+            owner, player, flame, exploded, fuse, x, y = fields[n:n+7]
+            b = object.__new__(Bomb)
+            b.state = state
+            b.coords = (x, y)
+            b.original_owner = players[owner]
+            b.player = players[player]
+            b.flame = flame
+            b.exploded = bool(exploded)
+            b.fuse = fuse
+            if len(bombs) < meta['live']:
+                b.original_owner._bombs_live.append(b)
+            bombs.append(b)
+
+        flames = []
+        fields = _ints(flame_data, swap=swap)
+        for n in xrange(0, len(fields), 2):
+            arms, bomb = fields[n:n+2]
+            f = object.__new__(FLAME_KINDS[arms])
+            f.state = state
+            f.arms = arms
+            f.bomb = bombs[bomb]
+            f.burning = True
+            flames.append(f)
+
+        cols = arena.cols
+        fields = _ints(entities, swap=swap)
+        for n in xrange(0, len(fields), 3):
+            i, kind, ref = fields[n:n+3]
+            coords = (i % cols, i // cols)
+            if kind == _SNAP_PLAYER:
+                o = players[ref]
+            elif kind == _SNAP_BOMB:
+                o = bombs[ref]
+            elif kind == _SNAP_FLAME:
+                o = flames[ref]
+                o.coords = coords
+            else:
+                o = (PowerupFlame if kind == _SNAP_POWERUP_FLAME else PowerupBomb)(state=None, coords=coords)
+                o.state = state
+            arena.coords_add(coords, o)
+
+        for wheel, now, data, objs in ((state._bomb_wheel, meta['bomb_now'], bomb_wheel, bombs),
+                                       (state._flame_wheel, meta['flame_now'], flame_wheel, flames)):
+            wheel.now = now
+            fields = _ints(data, swap=swap)
+            for n in xrange(0, len(fields), 2):
+                wheel.slots.setdefault(fields[n], []).append(objs[fields[n+1]])
+
+        state._player_queue = udeque(players[n] for n in meta['queue'])
+        state._alive = udeque(players[n] for n in meta['alive'])
+        state._sticky_actions = dict((players[n], action) for n, action in meta['sticky'])
+
+        fields = _ints(action_queues, swap=swap)
+        n = 0
+        while n < len(fields):
+            player, maxlen, length = fields[n:n+3]
+            n += 3
+            entries = [tuple(fields[m:m+2]) for m in xrange(n, n + 2*length, 2)]
+            n += 2*length
+            state._action_queues[players[player]] = deque(entries, None if maxlen == -1 else maxlen)
+
+        # the same version as when the snapshot was taken, with nothing left to redraw
+        state._version_base = meta['version_base']
+        arena.version = meta['arena_version']
+        arena.take_dirty()
+
+        return state, players
 
     def action_add(self, player, action):
-        """Add player actions to a queue for processing"""
-        self._action_queue.appendleft((player, action))
+        """Add player actions to a queue for processing; anything that isn't an action is ignored"""
+        if action not in Player.ACTIONS:
+            return
+
+        for log in self.logs:
+            log.add(self.now, player, action)
+        try:
+            queue = self._action_queues[player]
+        except KeyError:
+            queue = self._action_queues[player] = deque(maxlen=self.action_queue_max)
+
+        if self.action_coalesce and not self._action_coalesce(queue, action):
+            return
+
+        queue.append((self._action_seq, action))
+        self._action_seq += 1
+
+    @staticmethod
+    def _action_coalesce(queue, action):
+        """Make way for an action in a queue holding only one movement and one bomb; False if it's not needed"""
+        for entry in queue:
+            if action == Player.BOMB and entry[1] == Player.BOMB:
+                return False
+
+            if action != Player.BOMB and entry[1] != Player.BOMB:
+                queue.remove(entry)
+                break
+
+        return True
 
     def _actions_process(self):
-        """Process queued actions or fall back to sticky actions"""
-        unexecuted = deque()
-        had_turn = []
-        while self._action_queue:
-            player, action = self._action_queue.pop()
-            if player in had_turn:
-                unexecuted.appendleft((player, action))
-            else:
-                self._player_action(player, action)
+        """
+        Process each player's oldest queued action or fall back to their sticky
+        action; players take their turns in the order their actions were queued
+        """
+        queues = self._action_queues
+        had_turn = set()
+        turns = sorted((queue[0][0], player) for player, queue in queues.iteritems()) if queues else ()
+        for _, player in turns:
+            queue = queues[player]
+            _, action = queue.popleft()
+            if not queue:
+                del queues[player]
+
+            self._player_action(player, action)
+            if player in self._alive:
                 self._player_sticky(player, action)
-                had_turn.append(player)
+            had_turn.add(player)
 
-        for player in self._sticky_actions:
-            if player not in had_turn:
-                self._player_action(player, self._sticky_actions[player])
-
-        self._action_queue = unexecuted
+        sticky = self._sticky_actions
+        for player in list(self._alive): # moving may remove the player
+            if player not in had_turn and sticky.get(player) is not None:
+                self._player_action(player, sticky[player])
 
     def _player_action(self, player, action):
         """Perform player action"""
-        try:
-            px, py = player.coords
-        except TypeError:
-            # coords are invalid, player is not in the arena: noop
+        if player not in self._alive:
+            return
+
+        px, py = player.coords
+
+        if action == Player.BOMB:
+            player.drop_bomb()
             return
 
         try:
-            if action == Player.BOMB:
-                player.drop_bomb()
-            elif action == Player.UP:
-                player.move((px, py-1))
-            elif action == Player.DOWN:
-                player.move((px, py+1))
-            elif action == Player.LEFT:
-                player.move((px-1, py))
-            elif action == Player.RIGHT:
-                player.move((px+1, py))
-        except IndexError:
+            dx, dy = self._moves[action]
+        except KeyError:
+            return
+
+        new_coords = (px+dx, py+dy)
+        if self.arena.passable(new_coords):
+            player.move(new_coords)
+        else:
             self._sticky_actions[player] = None
 
+    def passable(self, coords):
+        """Whether a player could move onto coords, for bots to find their way with"""
+        return self.arena.passable(coords)
+
+    def _player_gone(self, player):
+        """Forget about a player that has left the arena, until they spawn again"""
+        self._alive.discard(player)
+        self._sticky_actions.pop(player, None)
+
     def _player_sticky(self, player, action):
         """Add actions to "sticky" lookup, if applicable"""
         if action == Player.BOMB:
@@ -556,14 +1159,43 @@ class GameState(object):
         else:
             self._sticky_actions[player] = action
 
+    def _blast(self, f, *args):
+        """Queue explosion work and see it done"""
+        self._blasts.append((f, args))
+        self._blasts_resolve()
+
+    def _blasts_resolve(self):
+        """
+        Work through the explosion queue, unless we're already doing so; work is
+        done last in, first out, so that chain reactions resolve in the same
+        order as they would by recursion, but without the stack depth
+        """
+        if self._blasting:
+            return
+
+        self._blasting = True
+        try:
+            while self._blasts:
+                f, args = self._blasts.pop()
+                f(*args)
+        finally:
+            self._blasting = False
+
+    def _bomb_due(self, bomb):
+        """Explode a bomb whose time has come, unless it has been set off already"""
+        if not bomb.exploded:
+            bomb.explode()
+
     def _bombs_process(self):
-        """Tick bombs"""
-        for p in self._sticky_actions:
-            for b in p._bombs_live[:]: # copy the list so we can safely iterate
-                if b in p._bombs_live:
-                    b.tick()
+        """Tick bombs, exploding those due as one batch; bombs ticked on ahead are skipped"""
+        due = [b for b in self._bomb_wheel.advance() if b.fuse == self._bomb_wheel.now]
+        for b in reversed(due):
+            self._blasts.append((self._bomb_due, (b,)))
+
+        self._blasts_resolve()
 
     def _flames_process(self):
-        """Tick the flames"""
-        for f in self._flames[:]: # copy the list so we can safely iterate
-            f.tick()
+        """Tick the flames, removing those due"""
+        for f in self._flame_wheel.advance():
+            if f.burning:
+                f.tick()
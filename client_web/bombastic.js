@@ -2,6 +2,7 @@ function Game() {
     var uid,
         websocket,
         last_frame,
+        version,
         img_refs = [],
         lookup_prefix = 'img/',
         lookup = {
@@ -64,34 +65,45 @@ function Game() {
     }
 
     var table_build = function () {
-        $.read('/game', function(resp) {
-            var table = document.getElementById('game'),
-                table_row = document.createElement('tr'),
-                table_cell,
-                img;
-
-            last_frame = resp;
-
-            for (i = 0; i < resp.length; i++) {
-                var c = resp.charAt(i);
-                if (c == "\n") {
-                    table.appendChild(table_row);
-                    table_row = document.createElement('tr');
-                    continue;
-                }
-                table_cell = document.createElement('td');
-                img        = document.createElement('img');
-                img_refs[i] = img;
-                img.setAttribute('src', lookup_prefix + get_img_for(c));
-                table_cell.appendChild(img);
-                table_row.appendChild(table_cell);
+        $.read('/game', table_build_from);
+    }
+
+    var table_build_from = function (frame) {
+        if (last_frame != undefined) {
+            // already built, e.g. from a keyframe
+            return;
+        }
+
+        var table = document.getElementById('game'),
+            table_row = document.createElement('tr'),
+            table_cell,
+            img;
+
+        last_frame = frame;
+
+        for (i = 0; i < frame.length; i++) {
+            var c = frame.charAt(i);
+            if (c == "\n") {
+                table.appendChild(table_row);
+                table_row = document.createElement('tr');
+                continue;
             }
-        });
+            table_cell = document.createElement('td');
+            img        = document.createElement('img');
+            img_refs[i] = img;
+            img.setAttribute('src', lookup_prefix + get_img_for(c));
+            table_cell.appendChild(img);
+            table_row.appendChild(table_cell);
+        }
     }
 
-    var table_update = function (resp) {
-        for (i = 0; i < resp.game.length; i++) {
-            var c  = resp.game.charAt(i);
+    var table_update = function (frame) {
+        if (last_frame == undefined) {
+            return table_build_from(frame);
+        }
+
+        for (i = 0; i < frame.length; i++) {
+            var c  = frame.charAt(i);
             if (c == "\n") {
                 continue;
             }
@@ -101,7 +113,35 @@ function Game() {
                 img_refs[i].setAttribute('src', lookup_prefix + get_img_for(c));
             }
         }
-        last_frame = resp.game;
+        last_frame = frame;
+    }
+
+    var table_patch = function (cells) {
+        var chars = last_frame.split('');
+        for (i = 0; i < cells.length; i++) {
+            var pos = cells[i][0],
+                c   = cells[i][1];
+            chars[pos] = c;
+            img_refs[pos].setAttribute('src', lookup_prefix + get_img_for(c));
+        }
+        last_frame = chars.join('');
+    }
+
+    var frame_receive = function (resp) {
+        if (resp.type == 'key') {
+            table_update(resp.game);
+            version = resp.version;
+        } else if (resp.type == 'delta') {
+            if (resp.base != version || last_frame == undefined) {
+                // we missed something; ask for a keyframe
+                websocket.send('RESYNC');
+                return;
+            }
+            table_patch(resp.cells);
+            version = resp.version;
+        } else if (resp.game != undefined) {
+            table_update(resp.game);
+        }
     }
 
     uid = window.location.search.substr(window.location.search.indexOf('uid=') + 4, 32);
@@ -115,7 +155,7 @@ function Game() {
     }
     websocket = new WebSocket(ws_uri);
     websocket.onmessage = function(e) {
-        table_update(JSON.parse(e.data));
+        frame_receive(JSON.parse(e.data));
     }
     // grr I didn't need this before; why do I need to set a timeout now?!
     setTimeout(function () {
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""Run games without a server, as fast as they'll go"""
+
+from bomber import GameState, Player
+from replay import InputLog
+import argparse
+import random
+import time
+
+class Headless(object):
+
+    """
+    Drive a GameState tick by tick with no clock and no network; inputs are
+    either a script of (tick, player index, action) entries or a function
+    called as inputs(tick, state, players) that returns (player, action) pairs
+    """
+
+    def __init__(self, state, players, inputs=None, capture=False):
+        self.state = state
+        self.players = players
+        self.capture = capture # keep the frame after every tick
+        self.frames = []
+        self.tick = 0
+
+        if inputs is None or callable(inputs):
+            self.inputs = inputs
+            self.script = {}
+        else:
+            self.inputs = None
+            self.script = {}
+            for tick, number, action in inputs:
+                self.script.setdefault(tick, []).append((players[number], action))
+
+    def step(self):
+        """Queue the inputs for the current tick, then run it"""
+        for player, action in self.script.get(self.tick, ()):
+            self.state.action_add(player, action)
+
+        if self.inputs is not None:
+            for player, action in self.inputs(self.tick, self.state, self.players):
+                self.state.action_add(player, action)
+
+        self.state.tick()
+        if self.capture:
+            self.frames.append(str(self.state))
+
+        self.tick += 1
+
+    def run(self, ticks):
+        """Run a number of ticks, returning how many were run per second"""
+        start = time.time()
+        for _ in xrange(ticks):
+            self.step()
+
+        return ticks / max(time.time() - start, 1e-9)
+
+def random_bots(seed=0, chance=0.5):
+    """Inputs for players that mash keys at random, respawning whenever they're all dead"""
+    rand = random.Random(seed)
+    actions = [Player.UP, Player.DOWN, Player.LEFT, Player.RIGHT, Player.BOMB]
+
+    def inputs(tick, state, players):
+        if all(p.coords is None for p in players):
+            for p in players:
+                state.player_add(p)
+            state.spawn()
+
+        return [(p, rand.choice(actions)) for p in players if rand.random() < chance]
+
+    return inputs
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--ticks', type=int, default=100000)
+    parser.add_argument('--arena', default='default.bmm')
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chance', type=float, default=0.5, help='chance of each bot acting on each tick')
+    parser.add_argument('--capture', action='store_true', help='keep the frame after every tick')
+    parser.add_argument('--profile', action='store_true', help='show where the time goes')
+    parser.add_argument('--record', metavar='FILE', help='log the inputs to FILE, for replay.py')
+    args = parser.parse_args()
+
+    state = GameState(seed=args.seed, arena=("arenas", args.arena))
+    if args.record:
+        state.record(InputLog(open(args.record, 'w')))
+    players = [Player() for _ in xrange(args.players)]
+    for p in players:
+        state.player_add(p)
+    state.spawn()
+
+    runner = Headless(state, players, random_bots(args.seed, args.chance), capture=args.capture)
+    if args.profile:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        tps = profiler.runcall(runner.run, args.ticks)
+        pstats.Stats(profiler).sort_stats('tottime').print_stats(20)
+    else:
+        tps = runner.run(args.ticks)
+
+    print "%d ticks on %s, %d players: %.0f ticks per second" % (args.ticks, args.arena, args.players, tps)
+
+if __name__ == '__main__':
+    main()
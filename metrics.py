@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""Timings and counts of what goes on in a game, as JSON or in the Prometheus text format"""
+
+from bomber import Bomb, DestructibleBlock, Flame, Powerup
+from bisect import bisect_left
+import time
+
+# the phases of a tick that are timed, by the GameState method that runs them
+PHASES = (
+    ('flames', '_flames_process'),
+    ('actions', '_actions_process'),
+    ('bombs', '_bombs_process'),
+)
+
+# what the game counts as it goes: (name, GameState attribute, help)
+COUNTS = (
+    ('explosions', 'explosions', "Bombs exploded"),
+    ('flames_made', 'flames_made', "Flames made"),
+    ('moves', 'moves', "Player moves"),
+    ('pickups', 'pickups', "Powerups picked up"),
+)
+
+# live objects, by the arena's index of where they are; there's only ever one of these to a space
+LIVE = (
+    ('bombs', Bomb),
+    ('flames', Flame),
+    ('powerups', Powerup),
+)
+
+def live(state):
+    """How many of each kind of object are live in a game, as (kind, count) pairs"""
+    counts = [(name, len(state.arena.index[cls])) for name, cls in LIVE]
+    counts.append(('destructible_blocks', state.arena.terrain_count(DestructibleBlock)))
+    counts.append(('players', len(state._alive)))
+    return counts
+
+class Histogram(object):
+
+    """
+    Durations in seconds, counted into buckets that double from a microsecond,
+    so that recording one is a bisect and an increment whatever has gone before;
+    percentiles are as fine as the buckets
+    """
+
+    BOUNDS = tuple(1e-6 * 2 ** n for n in xrange(23)) # up to ~4s, then the rest
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """Record a duration"""
+        self.buckets[bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """The upper bound of the bucket holding the q'th percentile, or the longest duration if that's less"""
+        if not self.count:
+            return 0.0
+
+        rank = q / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+
+        return self.max
+
+_BOUNDS_LABELS = tuple(repr(bound) for bound in Histogram.BOUNDS)
+
+class TickMetrics(object):
+
+    """
+    Report the counts a game keeps and what's live in it, along with how long
+    the phases of its ticks take once attached; until then nothing is timed,
+    so the game runs just as it would without metrics
+    """
+
+    def __init__(self, state, clock=time.time):
+        self.state = state
+        self.clock = clock
+        self.phases = dict((name, Histogram()) for name, _ in PHASES)
+
+    def attach(self):
+        """Time the game's phases from now on, by shadowing them with timed versions on the instance"""
+        for name, method in PHASES:
+            setattr(self.state, method, self._timed(self.phases[name], getattr(self.state, method)))
+
+    def detach(self):
+        """Stop timing the game's phases"""
+        for _, method in PHASES:
+            self.state.__dict__.pop(method, None)
+
+    def _timed(self, histogram, f):
+        clock = self.clock
+        def timed():
+            start = clock()
+            try:
+                f()
+            finally:
+                histogram.add(clock() - start)
+        return timed
+
+    def report(self):
+        """Everything, as a dict for JSON"""
+        state = self.state
+        return dict(ticks=state.now,
+                    phases=dict((name, dict(count=h.count,
+                                            sum=h.sum,
+                                            p50=h.percentile(50),
+                                            p99=h.percentile(99),
+                                            max=h.max))
+                                for name, h in self.phases.iteritems()),
+                    counts=dict((name, getattr(state, attr)) for name, attr, _ in COUNTS),
+                    live=dict(live(state)),
+                    action_queues=len(state._action_queues),
+                    actions_queued=sum(len(q) for q in state._action_queues.itervalues()))
+
+    def prometheus(self, prefix='bomber'):
+        """Everything, in the Prometheus text exposition format"""
+        lines = []
+        def metric(name, kind, text, samples):
+            lines.append("# HELP %s_%s %s" % (prefix, name, text))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+            for suffix, labels, value in samples:
+                labels = ','.join('%s="%s"' % label for label in labels)
+                lines.append("%s_%s%s%s %r" % (prefix, name, suffix, '{%s}' % labels if labels else '', value))
+
+        samples = []
+        for name, _ in PHASES:
+            h = self.phases[name]
+            seen = 0
+            for bound, count in zip(_BOUNDS_LABELS, h.buckets):
+                seen += count
+                samples.append(('_bucket', (('phase', name), ('le', bound)), seen))
+            samples.append(('_bucket', (('phase', name), ('le', '+Inf')), h.count))
+            samples.append(('_sum', (('phase', name),), h.sum))
+            samples.append(('_count', (('phase', name),), h.count))
+        metric('phase_seconds', 'histogram', "Time taken by each phase of a tick", samples)
+
+        state = self.state
+        metric('ticks_total', 'counter', "Ticks processed", [('', (), state.now)])
+        for name, attr, text in COUNTS:
+            metric('%s_total' % name, 'counter', text, [('', (), getattr(state, attr))])
+        metric('live_objects', 'gauge', "Objects of each kind in the game",
+               [('', (('kind', name),), count) for name, count in live(state)])
+        metric('action_queues', 'gauge', "Players with actions queued", [('', (), len(state._action_queues))])
+        metric('actions_queued', 'gauge', "Actions queued, over all players",
+               [('', (), sum(len(q) for q in state._action_queues.itervalues()))])
+
+        return '\n'.join(lines) + '\n'
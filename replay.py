@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+"""Record games as their inputs, and replay them flat out"""
+
+from bomber import GameState, Player
+import argparse
+import base64
+from bisect import bisect_right
+from collections import deque
+import json
+import mmap
+import struct
+from pprint import pprint
+import time
+import zlib
+
+# keyframed replay files: a header, a segment per keyframe, an index of the segments, then a trailer
+REPLAY_MAGIC = 'BOMBREPL'
+_HEADER  = struct.Struct('<8sI')   # magic, length of the JSON header that follows
+_SEGMENT = struct.Struct('<III')   # tick, length of the keyframe snapshot that follows, inputs after that
+_INPUT   = struct.Struct('<Iib')   # tick, player, action
+_OFFSET  = struct.Struct('<Q')     # index entry: where a segment starts
+_TRAILER = struct.Struct('<QII8s') # where the index starts, segments, ticks, magic
+
+def frame_hash(state):
+    """A checksum of the rendered game state"""
+    return zlib.crc32(str(state)) & 0xffffffff
+
+def input_apply(state, player, action):
+    """Apply a logged input to a game"""
+    if action == GameLog.SPAWN:
+        state.spawn()
+    elif action == GameLog.JOIN:
+        state.player_add(player)
+    elif action == GameLog.LEAVE:
+        state.player_remove(player)
+    else:
+        state.action_add(player, action)
+
+class ReplayMismatch(Exception):
+
+    """A replayed frame differs from the one recorded"""
+
+    def __init__(self, tick, recorded, replayed):
+        super(ReplayMismatch, self).__init__("Tick %d: frame hash %08x, recorded %08x" % (tick, replayed, recorded))
+        self.tick = tick
+
+class GameLog(object):
+
+    """
+    Base for the logs that GameState.record() takes: they're started with
+    the game, then told of each input as it's added and each tick once it's
+    processed. Players are given by the order they joined in, as their
+    numbers are reused on each spawn
+    """
+
+    # actions beyond those of Player
+    JOIN  = -1
+    LEAVE = -2
+    SPAWN = -3 # for the whole game, so with no player
+
+    def __init__(self):
+        self._players = [] # by the order they joined
+        self._indexes = {} # player -> index
+
+    def _index(self, player):
+        """A player's index, numbering them if they're new; -1 for no player"""
+        if player is None:
+            return -1
+
+        try:
+            return self._indexes[player]
+        except KeyError:
+            index = self._indexes[player] = len(self._players)
+            self._players.append(player)
+            return index
+
+    def _snapshot_take(self, state):
+        """A snapshot of the game, with its table of players in the order they joined: (tick, snapshot)"""
+        self._players = state.players_known(self._players)
+        for n in xrange(len(self._indexes), len(self._players)):
+            self._indexes[self._players[n]] = n
+        return state.now, state.snapshot(self._players)
+
+    @staticmethod
+    def _settings(state):
+        """What a game is played with, beyond its inputs, for a log's header"""
+        return dict(seed=state.seed,
+                    every=list(state.every),
+                    action_queue_max=state.action_queue_max,
+                    action_coalesce=state.action_coalesce)
+
+class InputLog(GameLog):
+
+    """
+    The inputs to a game as (tick, player, action) entries, enough to play it
+    out again given the seed and settings it started with, and the frame
+    hashed every hash_every ticks to check replays against
+
+    With a file, everything is written there as it happens instead of being
+    kept, so that a long game doesn't build up in memory: a JSON header then a
+    line per entry, [tick, player, action] for inputs and [tick, hash] for
+    frame hashes, which load() reads back
+    """
+
+    def __init__(self, fp=None, hash_every=1):
+        super(InputLog, self).__init__()
+        self.fp = fp
+        self.hash_every = hash_every
+        self.header = None
+        self.inputs = []
+        self.hashes = {} # tick -> frame hash after it
+        self.ticks = 0
+
+    def start(self, state):
+        """Note what a game starts with: the map, or a snapshot if it's under way"""
+        self.header = self._settings(state)
+        self.header['hash_every'] = self.hash_every
+        if state.now or state.players_known() or state._arena_lines is None:
+            _, snapshot = self._snapshot_take(state)
+            self.header['snapshot'] = base64.b64encode(snapshot)
+        else:
+            self.header['arena'] = state._arena_lines
+
+        self._write(self.header)
+
+    def add(self, tick, player, action):
+        """Note an input, which takes effect on the next tick processed"""
+        entry = (tick, self._index(player), action)
+        if self.fp is None:
+            self.inputs.append(entry)
+        else:
+            self._write(entry)
+
+    def ticked(self, state):
+        """Note a tick processed, hashing the frame when it's due"""
+        self.ticks = state.now
+        if state.now % self.hash_every == 0:
+            h = frame_hash(state)
+            if self.fp is None:
+                self.hashes[state.now] = h
+            else:
+                self._write((state.now, h))
+
+    def _write(self, entry):
+        if self.fp is not None:
+            self.fp.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    @classmethod
+    def load(cls, fp):
+        """Read a log from a file written as it was recorded"""
+        log = cls()
+        log.header = json.loads(fp.readline())
+        log.hash_every = log.header['hash_every']
+        log.ticks = log.header.get('ticks', 0)
+        for line in fp:
+            entry = json.loads(line)
+            if len(entry) == 3:
+                log.inputs.append(tuple(entry))
+            else:
+                log.hashes[entry[0]] = entry[1]
+            log.ticks = max(log.ticks, entry[0])
+
+        return log
+
+    def state(self):
+        """A game state as the recorded game started, and its players in order: (state, players)"""
+        header = self.header
+        if 'snapshot' in header:
+            return GameState.restore(base64.b64decode(header['snapshot']))
+
+        state = GameState(seed=header['seed'], arena=None)
+        state.arena_build(header['arena'])
+        state.every = tuple(header['every'])
+        state.action_queue_max = header['action_queue_max']
+        state.action_coalesce = header['action_coalesce']
+        return state, []
+
+class Replay(object):
+
+    """
+    Play a recorded game out again from a state, applying inputs of (tick,
+    player, action) as their ticks come up and checking each frame that has a
+    hash against it; players are by the order they joined, as in InputLog
+    """
+
+    def __init__(self, state, players, inputs, hashes=None, ticks=None):
+        self.state = state
+        self.players = list(players)
+        self.hashes = hashes or {}
+        self.ticks = ticks # the last tick recorded
+        self._inputs = iter(inputs)
+        self._input = next(self._inputs, None) # the next input to apply
+
+    @classmethod
+    def from_log(cls, log, check=True):
+        """Replay an InputLog from the start"""
+        state, players = log.state()
+        return cls(state, players, log.inputs, log.hashes if check else None, log.ticks)
+
+    def player(self, index):
+        """The player who joined in the given order"""
+        while len(self.players) <= index:
+            self.players.append(Player())
+
+        return self.players[index]
+
+    def inputs_apply(self):
+        """Apply the inputs for the current tick"""
+        state = self.state
+        while self._input is not None and self._input[0] <= state.now:
+            _, index, action = self._input
+            input_apply(state, None if index < 0 else self.player(index), action)
+            self._input = next(self._inputs, None)
+
+    def step(self):
+        """Apply the inputs for the current tick, then run it"""
+        state = self.state
+        self.inputs_apply()
+        state.tick()
+        if state.now in self.hashes:
+            recorded = self.hashes[state.now]
+            replayed = frame_hash(state)
+            if replayed != recorded:
+                raise ReplayMismatch(state.now, recorded, replayed)
+
+    def run(self, ticks=None):
+        """Run to the last tick recorded, or as many ticks as given, returning how many were run per second"""
+        if ticks is None:
+            ticks = self.ticks - self.state.now
+
+        start = time.time()
+        for _ in xrange(ticks):
+            self.step()
+
+        return ticks / max(time.time() - start, 1e-9)
+
+class ReplayWriter(GameLog):
+
+    """
+    Record a game as a keyframed replay file: the whole game is snapshotted
+    every keyframe_every ticks, followed by the inputs up to the next keyframe, so
+    that any tick can be reached by loading the keyframe before it and
+    playing out the rest; close() writes the index that seeking goes by
+    """
+
+    def __init__(self, fp, keyframe_every=1000):
+        super(ReplayWriter, self).__init__()
+        self.fp = fp
+        self.keyframe_every = keyframe_every
+        self.ticks = 0
+        self._offsets = [] # where each segment starts
+        self._keyframe = None # (tick, snapshot) for the segment being recorded
+        self._inputs = []
+
+    def start(self, state):
+        """Write the header and the first keyframe"""
+        header = json.dumps(dict(seed=state.seed, keyframe_every=self.keyframe_every))
+        self.fp.write(_HEADER.pack(REPLAY_MAGIC, len(header)) + header)
+        self._keyframe = self._snapshot_take(state)
+
+    def add(self, tick, player, action):
+        """Note an input, which takes effect on the next tick processed"""
+        self._inputs.append(_INPUT.pack(tick, self._index(player), action))
+
+    def ticked(self, state):
+        """Note a tick processed, starting a new segment when a keyframe is due"""
+        self.ticks = state.now
+        if state.now % self.keyframe_every == 0:
+            self._segment_write()
+            self._keyframe = self._snapshot_take(state)
+
+    def _segment_write(self):
+        tick, keyframe = self._keyframe
+        self._offsets.append(self.fp.tell())
+        self.fp.write(_SEGMENT.pack(tick, len(keyframe), len(self._inputs)))
+        self.fp.write(keyframe)
+        self.fp.write(''.join(self._inputs))
+        self._inputs = []
+
+    def close(self):
+        """Write the last segment and the index, and close the file"""
+        self._segment_write()
+        index = self.fp.tell()
+        self.fp.write(''.join(_OFFSET.pack(offset) for offset in self._offsets))
+        self.fp.write(_TRAILER.pack(index, len(self._offsets), self.ticks, REPLAY_MAGIC))
+        self.fp.close()
+
+class CrashLog(GameLog):
+
+    """
+    Keep what it takes to work out a game as it was before a crash, cheaply:
+    a snapshot every `ticks` ticks, and the inputs of the last `ticks` ticks
+    in a ring buffer, which always reaches back to the snapshot
+    """
+
+    def __init__(self, ticks=64):
+        super(CrashLog, self).__init__()
+        self.ticks = ticks
+        self.batches = deque(maxlen=ticks) # inputs of each tick processed, as (tick, player, action)
+        self.header = None
+        self._batch = [] # inputs for the tick to come
+        self._snapshot = None # (tick, snapshot)
+
+    def start(self, state):
+        """Note the game's settings, and take the first snapshot"""
+        self.header = self._settings(state)
+        self.header['hash_every'] = 0
+        self._snapshot = self._snapshot_take(state)
+
+    def add(self, tick, player, action):
+        """Note an input, which takes effect on the next tick processed"""
+        self._batch.append((tick, self._index(player), action))
+
+    def ticked(self, state):
+        """Note a tick processed, taking a snapshot when one is due"""
+        self.batches.append(self._batch)
+        self._batch = []
+        if state.now % self.ticks == 0:
+            self._snapshot = self._snapshot_take(state)
+
+    def inputs(self):
+        """The inputs since the snapshot, including those for the tick to come"""
+        since = self._snapshot[0]
+        return [entry for batch in self.batches for entry in batch if entry[0] >= since] + self._batch
+
+    def last_state(self, now):
+        """The game as it was going into tick `now`, played out from the snapshot"""
+        tick, snapshot = self._snapshot
+        state, players = GameState.restore(snapshot)
+        replay = Replay(state, players, self.inputs())
+        replay.run(now - tick)
+        replay.inputs_apply()
+        return state
+
+    def dump(self, fp, state, error):
+        """Write out an error, the game going into the tick that raised it, the inputs leading up to it, and the game as it was left"""
+        last = self.last_state(state.now)
+        fp.write("%r\n" % error)
+        fp.write("last_state =\n%s\n" % last)
+        fp.write("last_arena =\n")
+        pprint(last.arena.data, fp)
+        fp.write("inputs =\n")
+        pprint([entry for batch in self.batches for entry in batch] + self._batch, fp)
+        fp.write("state =\n%s\n" % state)
+        fp.write("arena =\n")
+        pprint(state.arena.data, fp)
+        fp.write("\n\n\n")
+
+    def write(self, fp, now):
+        """Write an InputLog that plays out from the snapshot to the end of tick `now`, for replay.py to run again"""
+        tick, snapshot = self._snapshot
+        header = dict(self.header, snapshot=base64.b64encode(snapshot), ticks=now + 1)
+        fp.write(json.dumps(header, separators=(',', ':')) + '\n')
+        for entry in self.inputs():
+            fp.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+class ReplayReader(object):
+
+    """
+    Read a keyframed replay file through a memory map, so that seeking only
+    touches the index, the keyframe before the tick sought and the inputs
+    after it, however long the game; a recording of a game under way starts
+    from the tick it was taken up on, so segments are found by their ticks
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, length = _HEADER.unpack_from(self._map, 0)
+        if magic != REPLAY_MAGIC:
+            raise ValueError("Not a replay file: %s" % path)
+        self.header = json.loads(self._map[_HEADER.size:_HEADER.size + length])
+        self.keyframe_every = self.header['keyframe_every']
+
+        self._index, self.segments, self.ticks, magic = _TRAILER.unpack_from(self._map, len(self._map) - _TRAILER.size)
+        if magic != REPLAY_MAGIC:
+            raise ValueError("Replay file has no index, as it wasn't closed: %s" % path)
+
+        self._starts = [self._segment_tick(n) for n in xrange(self.segments)] # the tick of each keyframe
+        self.start = self._starts[0]
+
+    def close(self):
+        self._map.close()
+
+    def _segment_tick(self, n):
+        """The tick a segment's keyframe was taken after"""
+        offset, = _OFFSET.unpack_from(self._map, self._index + n * _OFFSET.size)
+        return _SEGMENT.unpack_from(self._map, offset)[0]
+
+    def _segment(self, n):
+        """Where a segment's keyframe starts and ends, and how many inputs follow"""
+        offset, = _OFFSET.unpack_from(self._map, self._index + n * _OFFSET.size)
+        _, length, count = _SEGMENT.unpack_from(self._map, offset)
+        start = offset + _SEGMENT.size
+        return start, start + length, count
+
+    def _inputs(self, n):
+        """The inputs from a segment on, read as they're asked for"""
+        for n in xrange(n, self.segments):
+            _, offset, count = self._segment(n)
+            for i in xrange(count):
+                yield _INPUT.unpack_from(self._map, offset + i * _INPUT.size)
+
+    def seek(self, tick):
+        """A Replay at the given tick, played out from the keyframe before it"""
+        if not self.start <= tick <= self.ticks:
+            raise IndexError("Tick %d is outside the replay, of ticks %d to %d" % (tick, self.start, self.ticks))
+
+        n = bisect_right(self._starts, tick) - 1
+        start, end, _ = self._segment(n)
+        state, players = GameState.restore(self._map[start:end])
+        replay = Replay(state, players, self._inputs(n), ticks=self.ticks)
+        replay.run(tick - state.now)
+        return replay
+
+    def frames(self, start=None, stop=None):
+        """(tick, frame) for each tick from start up to stop, played out as they're asked for"""
+        if start is None:
+            start = self.start
+        if stop is None:
+            stop = self.ticks + 1
+
+        replay = self.seek(start)
+        while True:
+            yield replay.state.now, str(replay.state)
+            if replay.state.now + 1 >= stop:
+                return
+            replay.step()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('log', help='a log written by InputLog, or a keyframed replay file')
+    parser.add_argument('--no-check', dest='check', action='store_false', help="don't check the frame hashes")
+    parser.add_argument('--profile', action='store_true', help='show where the time goes')
+    parser.add_argument('--write', metavar='FILE', help='write a keyframed replay file while replaying a log')
+    parser.add_argument('--keyframes', type=int, default=1000, help='ticks between keyframes, when writing')
+    parser.add_argument('--frame', type=int, metavar='TICK', help='show the frame at TICK of a keyframed replay file')
+    args = parser.parse_args()
+
+    with open(args.log, 'rb') as fp:
+        keyframed = fp.read(len(REPLAY_MAGIC)) == REPLAY_MAGIC
+
+    if keyframed:
+        reader = ReplayReader(args.log)
+        if args.frame is not None:
+            start = time.time()
+            frame = str(reader.seek(args.frame).state)
+            print frame
+            print "tick %d of %d: %.3fms" % (args.frame, reader.ticks, (time.time() - start) * 1000)
+        else:
+            start = time.time()
+            for _ in reader.frames():
+                pass
+            frames = reader.ticks - reader.start + 1
+            print "%d frames: %.0f per second" % (frames, frames / (time.time() - start))
+        return
+
+    with open(args.log) as fp:
+        log = InputLog.load(fp)
+
+    replay = Replay.from_log(log, check=args.check)
+    if args.write:
+        writer = ReplayWriter(open(args.write, 'wb'), args.keyframes)
+        replay.state.record(writer)
+
+    if args.profile:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        tps = profiler.runcall(replay.run)
+        pstats.Stats(profiler).sort_stats('tottime').print_stats(20)
+    else:
+        tps = replay.run()
+
+    if args.write:
+        writer.close()
+
+    print "%d ticks, %d inputs: %.0f ticks per second" % (log.ticks, len(log.inputs), tps)
+
+if __name__ == '__main__':
+    main()
@@ -2,29 +2,88 @@
 # coding: utf-8
 
 from bomber import GameState, Player
+from ticker import TickLoop
+from replay import InputLog, CrashLog
+from metrics import TickMetrics
 from twisted.internet import reactor
 from twisted.web import server, resource, http, util, static
 from autobahn.websocket import WebSocketServerFactory, WebSocketServerProtocol
 from simplejson.decoder import JSONDecodeError
-from pprint import pprint
 from functools import wraps
 import simplejson as json
+import struct
 import uuid
+import time
+import sys
+import os
 
 FLAME_TICK_TIME  = 1
 ACTION_TICK_TIME = 0.25
 BOMB_TICK_TIME   = 1
+BASE_TICK_TIME   = 0.25 # the phases above run on multiples of this
+
+WS_DELTA_FRAMES  = True # send WebSocket clients a keyframe, then only what changed
+
+ACTION_QUEUE_MAX = 16    # actions queued per player, so a flood of input can't build up
+ACTION_COALESCE  = False # queue only each player's latest movement and a single bomb
+
+RECORD_FILE      = 'game-%Y%m%d-%H%M%S.log' # where to log the inputs, for replay.py, by start time; None not to
+
+SNAPSHOT_FILE    = 'game.snapshot' # where to keep the game, to carry on from on restart; None not to
+SNAPSHOT_TIME    = 10 # seconds between snapshots
+
+CRASH_TICKS      = 64 # base ticks of inputs kept to work out the game before a crash, between snapshots of it
+CRASH_FILE       = 'crash-%Y%m%d-%H%M%S.log' # where to log the inputs leading up to a crash, for replay.py; None not to
+
+METRICS          = True # time the game's phases, for /admin/<uid>/metrics; False to leave the game untouched
 
 GAME = GameState()
+GAME.action_queue_max = ACTION_QUEUE_MAX
+GAME.action_coalesce = ACTION_COALESCE
 PLAYERS = {}
 ADMIN_UID = uuid.uuid4().hex
 
-def player_status(uid, player):
-    """Consistent output per player"""
-    info = dict(uid=uid, game=str(GAME))
+def snapshot_save(path):
+    """Snapshot the game along with the players' uids, writing it out in the background"""
+    uids = sorted(PLAYERS)
+    header = json.dumps(uids)
+    data = struct.pack('<I', len(header)) + header + GAME.snapshot([PLAYERS[uid] for uid in uids])
+    reactor.callInThread(file_replace, path, data)
+
+def file_replace(path, data):
+    """Write a file in one go, so that it's never found half written"""
+    with open(path + '.tmp', 'wb') as fp:
+        fp.write(data)
+    os.rename(path + '.tmp', path)
+
+def snapshot_load(path):
+    """Carry on with the game and players from a snapshot"""
+    global GAME
+    with open(path, 'rb') as fp:
+        data = fp.read()
+
+    length, = struct.unpack_from('<I', data)
+    uids = json.loads(data[4:4+length])
+    state, players = GameState.restore(data[4+length:])
+    state.action_queue_max = ACTION_QUEUE_MAX
+    state.action_coalesce = ACTION_COALESCE
+
+    GAME = HUB.game = TICK_METRICS.state = state
+    PLAYERS.clear()
+    PLAYERS.update(zip(uids, players))
+
+def player_stats(player):
+    """The stats we share about a player"""
+    stats = {}
     for stat in 'coords', 'number', 'flame', 'bomb',\
                 'kills', 'deaths', 'suicides', 'name':
-        info[stat] = getattr(player, stat)
+        stats[stat] = getattr(player, stat)
+    return stats
+
+def player_status(uid, player):
+    """Consistent output per player"""
+    info = dict(uid=uid, game=str(GAME), version=GAME.version)
+    info.update(player_stats(player))
     return info
 
 def json_req_handler(f):
@@ -152,9 +211,35 @@ class BomberAdminValid(BomberResource):
 
         return self.render_GET(request)
 
-    def getChild(self, uid, request):
+    def getChild(self, name, request):
+        if name == 'metrics':
+            return BomberMetrics(self.data)
+        return self
+
+class BomberMetrics(BomberResource):
+
+    """
+    Handle /admin/uid/metrics, and /admin/uid/metrics/prometheus for scraping
+    """
+
+    @json_req_handler
+    def render_GET(self, request):
+        return TICK_METRICS.report()
+
+    def getChild(self, name, request):
+        if name == 'prometheus':
+            return BomberMetricsPrometheus(self.data)
         return self
 
+class BomberMetricsPrometheus(BomberResource):
+
+    """
+    Handle /admin/uid/metrics/prometheus
+    """
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return TICK_METRICS.prometheus()
 
 class BomberState(BomberResource):
 
@@ -232,15 +317,92 @@ class BomberPlayerValid(BomberResource):
 
         return self.render_GET(request)
 
+def json_extend(encoded, extra):
+    """Add the members of extra to an already JSON encoded object, so the shared part isn't encoded again"""
+    if not extra:
+        return encoded
+
+    return encoded[:-1] + ', ' + json.dumps(extra)[1:]
+
+class Broadcaster(object):
+
+    """
+    Fan the game state out to WebSocket connections once per state changing
+    tick, encoding the parts of the messages that they share only once
+    """
+
+    def __init__(self, game):
+        self.game = game
+        self.connections = []
+
+    def subscribe(self, conn):
+        """Start sending to a connection, beginning with a keyframe"""
+        if conn not in self.connections:
+            self.connections.append(conn)
+
+        conn.version = None
+        self.send([conn])
+
+    def unsubscribe(self, conn):
+        """Stop sending to a connection"""
+        if conn in self.connections:
+            self.connections.remove(conn)
+
+    def broadcast(self):
+        """Send whatever changed to everyone"""
+        self.send(self.connections)
+
+    def frame(self, base):
+        """Encode the shared part of a message for clients at a given version"""
+        version = self.game.version
+        if not WS_DELTA_FRAMES:
+            return False, json.dumps(dict(version=version, game=str(self.game)))
+
+        cells = None
+        if base is not None:
+            cells = self.game.frame_delta(base)
+
+        if cells is None:
+            return True, json.dumps(dict(type='key', version=version, game=str(self.game)))
+
+        return False, json.dumps(dict(type='delta', base=base, version=version, cells=cells))
+
+    def send(self, connections):
+        """Send each connection what changed since it was last sent something"""
+        version = self.game.version
+        frames = {}
+        for conn in connections:
+            stats = player_stats(conn.player)
+            changed = dict((k, v) for k, v in stats.items() if conn.stats.get(k) != v)
+            if conn.version == version and not changed:
+                continue
+
+            try:
+                key, frame = frames[conn.version]
+            except KeyError:
+                key, frame = frames[conn.version] = self.frame(conn.version)
+
+            if not WS_DELTA_FRAMES:
+                stats['uid'] = conn._uid
+                conn.sendRaw(json_extend(frame, stats))
+            elif key:
+                conn.sendRaw(json_extend(frame, dict(uid=conn._uid, stats=stats)))
+            else:
+                conn.sendRaw(json_extend(frame, dict(stats=changed)))
+
+            conn.version = version
+            conn.stats = stats
+
+HUB = Broadcaster(GAME)
+TICK_METRICS = TickMetrics(GAME)
+
 class GameProtocol(WebSocketServerProtocol, object):
     def __init__(self, *args, **kwargs):
         super(GameProtocol, self).__init__(*args, **kwargs)
         self.uid = None
         self.player = None
-        self.sample_rate = min([FLAME_TICK_TIME, ACTION_TICK_TIME, BOMB_TICK_TIME]) / 2
-
-    def onOpen(self):
-        self.player_update()
+        self.version = None # the version of the game last sent
+        self.stats = {}
 
     def status_update(self):
         self.sendMessage("TODO: data here!")
@@ -249,12 +411,19 @@ class GameProtocol(WebSocketServerProtocol, object):
         self.player_quit()
 
     def sendMessage(self, message):
-        return super(GameProtocol, self).sendMessage(json.dumps(message))
+        return self.sendRaw(json.dumps(message))
+
+    def sendRaw(self, message):
+        """Send an already JSON encoded message"""
+        return super(GameProtocol, self).sendMessage(message)
 
     def onMessage(self, msg, binary):
         if self.player is None:
             return self.player_set(msg)
 
+        if msg == 'RESYNC':
+            return self.player_resync()
+
         self.player_act(msg)
 
     def player_set(self, uid):
@@ -263,21 +432,20 @@ class GameProtocol(WebSocketServerProtocol, object):
             self._uid = uid
         except KeyError:
             self.sendMessage("Invalid player UID")
+            return
+
+        HUB.subscribe(self)
 
     def player_act(self, action):
         GAME.action_add(self.player, getattr(Player, action))
 
+    def player_resync(self):
+        """The client missed a version; start again from a keyframe"""
+        HUB.subscribe(self)
+
     def player_quit(self):
+        HUB.unsubscribe(self)
         #GAME.player_remove(self.player)
-        pass
-
-    def player_update(self):
-        reactor.callLater(self.sample_rate, self.player_update)
-
-        if self.player is None:
-            return
-
-        self.sendMessage(player_status(self._uid, self.player))
 
 if __name__ == '__main__':
     listen = raw_input('hostname:port to listen on? defaults to localhost:21513 : ')
@@ -288,35 +456,61 @@ if __name__ == '__main__':
         hostname, port = 'localhost', 21513
 
     def traceerr(f, *args, **kwargs):
-        last_state = str(GAME)
-        last_arena = GAME.arena.data[:]
         try:
             f(*args, **kwargs)
         except Exception as e:
             reactor.stop()
+            # the game before the tick is played out again from the crash log, only now it's needed
             with file('trace.err', 'a') as tracefile:
-                tracefile.write("%r\n" % e)
-                tracefile.write("last_state =\n%s\n" % last_state)
-                tracefile.write("last_arena =\n")
-                pprint(last_arena, tracefile)
-                tracefile.write("\n")
-                tracefile.write("state =\n%s\n" % str(GAME))
-                tracefile.write("arena =\n")
-                pprint(GAME.arena.data, tracefile)
-                tracefile.write("\n\n\n")
+                CRASH.dump(tracefile, GAME, e)
+            if CRASH_FILE is not None:
+                with open(time.strftime(CRASH_FILE), 'w') as crashfile:
+                    CRASH.write(crashfile, GAME.now)
             raise
 
-    def tick_flames():
-        traceerr(GAME._flames_process)
-        reactor.callLater(FLAME_TICK_TIME, tick_flames)
-
-    def tick_actions():
-        traceerr(GAME._actions_process)
-        reactor.callLater(ACTION_TICK_TIME, tick_actions)
-
-    def tick_bombs():
-        traceerr(GAME._bombs_process)
-        reactor.callLater(BOMB_TICK_TIME, tick_bombs)
+    def snapshot_phase():
+        """Save a snapshot, carrying on without one if that fails rather than stopping the game loop"""
+        try:
+            snapshot_save(SNAPSHOT_FILE)
+        except Exception as e:
+            sys.stderr.write("Couldn't snapshot the game: %r\n" % e)
+
+    def phase(f):
+        """Run a game phase, tracing any errors"""
+        return lambda: traceerr(f)
+
+    def every(tick_time):
+        """How many base ticks make up the given time"""
+        return max(1, int(round(tick_time / BASE_TICK_TIME)))
+
+    def lagging(skipped, overran, stepped):
+        if stepped:
+            sys.stderr.write("Clock stepped back %.3fs: carrying on from now\n" % stepped)
+        if skipped or overran:
+            sys.stderr.write("Game loop is behind: skipped %d ticks, %d ticks overran\n" % (skipped, overran))
+
+    if SNAPSHOT_FILE is not None and os.path.exists(SNAPSHOT_FILE):
+        snapshot_load(SNAPSHOT_FILE)
+        print "Carrying on from %s, at tick %d" % (SNAPSHOT_FILE, GAME.now)
+
+    # the game runs the phases due on each base tick, so that a replay can run them the same
+    GAME.every = every(FLAME_TICK_TIME), every(ACTION_TICK_TIME), every(BOMB_TICK_TIME)
+    if RECORD_FILE is not None:
+        GAME.record(InputLog(open(time.strftime(RECORD_FILE), 'w', 1)))
+    CRASH = CrashLog(CRASH_TICKS)
+    GAME.record(CRASH)
+    if METRICS:
+        TICK_METRICS.attach()
+
+    phases = [(1, phase(GAME.tick))]
+    if SNAPSHOT_FILE is not None:
+        phases.append((every(SNAPSHOT_TIME), snapshot_phase))
+
+    loop = TickLoop(BASE_TICK_TIME,
+                    phases,
+                    reactor.callLater,
+                    after=HUB.broadcast,
+                    report=lagging)
 
     factory = WebSocketServerFactory()
     # TODO: choose a more sensible port
@@ -329,9 +523,7 @@ if __name__ == '__main__':
                       interface=hostname,
                       port=port)
 
-    reactor.callWhenRunning(tick_flames)
-    reactor.callWhenRunning(tick_actions)
-    reactor.callWhenRunning(tick_bombs)
+    reactor.callWhenRunning(loop.start)
 
     print "Listening on: http://%s:%d" % (hostname, port)
     print "Admin uid:", ADMIN_UID
@@ -5,8 +5,25 @@
 
 from unittest import TestCase
 from bomber import *
+from arena import Arena
+from ticker import TickLoop
+from wheel import TimingWheel
+from headless import Headless, random_bots
+from replay import InputLog, Replay, ReplayMismatch, ReplayWriter, ReplayReader, CrashLog
+from metrics import Histogram, TickMetrics
+from unittest import skipIf
+from StringIO import StringIO
+from itertools import count
+import codecs
 import os
 import random
+import tempfile
+
+try:
+    import numpy
+    import batch
+except ImportError:
+    batch = None
 
 class TestArena(TestCase):
 
@@ -44,6 +61,26 @@ class TestArena(TestCase):
 
         self.assertRaises(LookupError, arena.coords_remove, (0, 0), obj1)
 
+    def test_remove_move(self):
+        """Objects can be removed and moved without their coords"""
+        arena = Arena(2, 2)
+        obj1 = object()
+        obj2 = object()
+        arena.coords_add((0, 1), obj1)
+        arena.coords_add((0, 1), obj2)
+        arena.take_dirty()
+        version = arena.version
+
+        arena.move(obj1, (1, 1))
+        assert arena.data == [[], [], [obj2], [obj1]]
+        assert arena.version == version + 1
+        assert arena.take_dirty() == set([2, 3])
+
+        assert arena.remove(obj2) == obj2
+        assert arena.data == [[], [], [], [obj1]]
+        self.assertRaises(LookupError, arena.remove, obj2)
+        self.assertRaises(LookupError, arena.move, obj2, (0, 0))
+
     def test_coords_have_obj(self):
         """Coords contain an specified object"""
         arena = Arena(1, 2)
@@ -89,6 +126,125 @@ class TestArena(TestCase):
         self.assertRaises(IndexError, arena.sanity, (2, 4))
         self.assertRaises(IndexError, arena.sanity, (4, 3))
 
+class TestIndexedArena(TestCase):
+
+    """Quality control for the class-indexed arena"""
+
+    def test_coords_have_class(self):
+        """Bitmask follows adds and removes"""
+        arena = IndexedArena(2, 2, (Block, Powerup))
+        powerup1 = PowerupFlame(None, None)
+        powerup2 = PowerupBomb(None, None)
+        arena.coords_add((1, 1), powerup1)
+        arena.coords_add((1, 1), powerup2)
+        assert arena.coords_have_class((1, 1), Powerup)
+        assert not arena.coords_have_class((1, 1), Block)
+        assert not arena.coords_have_class((0, 0), Powerup)
+
+        arena.coords_remove((1, 1), powerup1)
+        assert arena.coords_have_class((1, 1), Powerup)
+        arena.coords_remove((1, 1), powerup2)
+        assert not arena.coords_have_class((1, 1), Powerup)
+
+    def test_coords_have_mask(self):
+        """Test for any of several classes at once"""
+        arena = IndexedArena(2, 2, (Block, Bomb, Flame))
+        arena.coords_add((0, 1), Block(None, None))
+        mask = arena.mask_for(Block, Bomb)
+        assert arena.coords_have_mask((0, 1), mask)
+        assert not arena.coords_have_mask((1, 1), mask)
+
+    def test_terrain_count(self):
+        """Terrain is counted from its codes, without being located"""
+        state = GameState(arena=None)
+        state.arena_build(["B..", ". S"])
+        arena = state.arena
+        assert DestructibleBlock not in arena.index
+        assert arena.terrain_count(DestructibleBlock) == 3
+        assert arena.terrain_count(SpawnPoint) == 1
+        assert not arena.dirty # built in full, so nothing to redraw
+        arena.coords_get((1, 0))[0].remove()
+        assert arena.terrain_count(DestructibleBlock) == 2
+
+    def test_unregistered_class(self):
+        """Unregistered classes are still found"""
+        arena = IndexedArena(2, 2, (Block,))
+        arena.coords_add((0, 1), Block(None, None))
+        assert arena.coords_have_class((0, 1), GameObject)
+        assert not arena.coords_have_class((0, 0), GameObject)
+
+    def test_class_coords(self):
+        """Index of coords by class follows adds and removes"""
+        arena = IndexedArena(2, 2, (Block, Powerup))
+        powerup1 = PowerupFlame(None, None)
+        powerup2 = PowerupBomb(None, None)
+        arena.coords_add((1, 1), powerup1)
+        arena.coords_add((1, 1), powerup2)
+        arena.coords_add((0, 1), Block(None, None))
+        assert arena.class_coords(Powerup) == set([(1, 1)])
+        assert arena.class_coords(Block) == set([(0, 1)])
+        assert arena.class_coords(GameObject) == set([(1, 1), (0, 1)])
+
+        arena.coords_remove((1, 1), powerup1)
+        assert arena.class_coords(Powerup) == set([(1, 1)])
+        arena.coords_remove((1, 1), powerup2)
+        assert arena.class_coords(Powerup) == set()
+
+    def test_class_coords_unlocated(self):
+        """Classes that aren't located are still found"""
+        arena = IndexedArena(2, 2, (Block, Powerup), located=(Powerup,))
+        arena.coords_add((0, 1), Block(None, None))
+        assert arena.index.keys() == [Powerup]
+        assert arena.class_coords(Block) == set([(0, 1)])
+
+    def test_terrain(self):
+        """Terrain is kept as codes, with only the coords holding anything else having a list"""
+        arena = IndexedArena(2, 2, (DestructibleBlock, Powerup), terrain=(DestructibleBlock,))
+        block = DestructibleBlock(None, (1, 1))
+        powerup = PowerupFlame(None, (1, 1))
+        arena.coords_add((1, 1), block)
+        arena.coords_add((1, 1), powerup)
+        arena.coords_add((0, 1), DestructibleBlock(None, (0, 1)))
+        assert arena.entities.keys() == [3]
+        assert list(arena.terrain) == [0, 0, 1, 1]
+        assert arena.coords_get((1, 1)) == [block, powerup]
+        assert arena.coords_get((0, 1)) == [DestructibleBlock(None, (0, 1))]
+        assert arena.coords_get((0, 0)) == []
+
+        arena.coords_get((1, 1)).pop()
+        assert arena.coords_have_obj((1, 1), powerup)
+
+        arena.coords_remove((1, 1), DestructibleBlock(None, (1, 1)))
+        assert arena.coords_get((1, 1)) == [powerup]
+        assert not arena.coords_have_class((1, 1), DestructibleBlock)
+        assert arena.coords_have_class((1, 1), Powerup)
+        self.assertRaises(LookupError, arena.coords_remove, (1, 1), block)
+
+        arena.coords_remove((1, 1), powerup)
+        assert arena.entities == {}
+        assert [(x, y) for x, y, l in arena if l] == [(0, 1)]
+
+    def test_remove_move(self):
+        """Masks and index follow objects removed and moved without their coords"""
+        arena = IndexedArena(2, 2, (DestructibleBlock, Powerup, Player), terrain=(DestructibleBlock,))
+        arena.coords_add((1, 1), DestructibleBlock(None, (1, 1)))
+        player = Player()
+        powerup = PowerupBomb(None, (1, 1))
+        arena.coords_add((1, 1), player)
+        arena.coords_add((1, 1), powerup)
+
+        arena.move(player, (0, 1))
+        assert arena.coords_get((1, 1)) == [DestructibleBlock(None, (1, 1)), powerup]
+        assert arena.coords_get((0, 1)) == [player]
+        assert arena.class_coords(Player) == set([(0, 1)])
+
+        arena.remove(powerup)
+        arena.remove(DestructibleBlock(None, (1, 1)))
+        assert arena.coords_get((1, 1)) == []
+        assert not arena.coords_have_mask((1, 1), arena.mask_for(DestructibleBlock, Powerup, Player))
+        assert arena.entities.keys() == [2]
+        self.assertRaises(LookupError, arena.remove, powerup)
+
 class TestGameState(TestCase):
 
     """Tests for Game class"""
@@ -109,6 +265,99 @@ class TestGameState(TestCase):
         assert str(state) == arena.read()
         arena.close()
 
+    def test_version(self):
+        """Version increases with every change to the arena, and across arena loads"""
+        state = GameState()
+        version = state.version
+        str(state)
+        assert state.version == version
+
+        p1 = Player()
+        state.player_add(p1)
+        state.spawn()
+        assert state.version > version
+        version = state.version
+
+        state.arena_load(["arenas", "test.bmm"])
+        assert state.version > version
+
+    def test_render_cached(self):
+        """Rendering is cached until the next change"""
+        state = GameState()
+        frame = str(state)
+        assert str(state) is frame
+
+        p1 = Player()
+        state.player_add(p1)
+        state.spawn()
+        assert str(state) is not frame
+        assert str(state)[40:42] == 'B1'
+
+    def test_render_incremental(self):
+        """Redrawing only the changed coord spaces matches a full render"""
+        state = GameState()
+        p1 = Player()
+        p2 = Player()
+        p1.bomb = 2
+        p1.flame = 3
+        state.player_add(p1)
+        state.player_add(p2)
+        state.spawn()
+        for action in Player.DOWN, Player.BOMB, Player.UP, Player.RIGHT, Player.BOMB, Player.RIGHT:
+            state.action_add(p1, action)
+
+        for _ in xrange(10):
+            state.tick()
+            assert str(state) == state._render_full()
+
+    def test_frame_delta(self):
+        """Deltas bring an old frame up to date; unknown versions get None"""
+        state = GameState()
+        p1 = Player()
+        state.player_add(p1)
+        state.spawn()
+        frame = list(str(state))
+        version = state.version
+        assert state.frame_delta(version) == []
+
+        state.action_add(p1, Player.RIGHT)
+        state.tick()
+        str(state)
+        state.action_add(p1, Player.BOMB)
+        state.tick()
+        delta = state.frame_delta(version)
+        assert len(delta) == 2
+        for pos, c in delta:
+            frame[pos] = c
+
+        assert ''.join(frame) == str(state)
+        assert state.frame_delta(-1) is None
+
+        version = state.version
+        state.arena_load(["arenas", "test.bmm"])
+        assert state.frame_delta(version) is None
+
+    def test_reach(self):
+        """Flames reach as far as the Blocks allow"""
+        state = GameState()
+        up, down, left, right = xrange(len(DIRECTIONS))
+        assert state.reach((1, 1), up) == 0
+        assert state.reach((1, 1), left) == 0
+        assert state.reach((1, 1), right) == 36
+        assert state.reach((1, 1), down) == 16
+        assert state.reach((2, 1), down) == 0
+        assert state.reach((4, 3), up) == 0
+        assert state.reach((4, 3), left) == 3
+
+    def test_block_flyweight(self):
+        """Blocks are shared, and objects have no __dict__"""
+        state = GameState()
+        block = state.arena.coords_get((0, 0))[0]
+        assert isinstance(block, Block)
+        assert state.arena.coords_get((38, 18)) == [block]
+        assert not hasattr(block, '__dict__')
+        assert not hasattr(state.arena.coords_get((3, 1))[0], '__dict__')
+
     def test_player_number(self):
         """Check player numbers"""
         state = GameState()
@@ -168,6 +417,47 @@ class TestGameState(TestCase):
         state._actions_process()
         assert state._sticky_actions == {p1: Player.RIGHT}
 
+    def test_actions_turn_order(self):
+        """Players take turns in the order their actions were queued, one action each"""
+        state = GameState()
+        state.arena_load(["arenas", "empty.bmm"])
+        p1 = Player()
+        p2 = Player()
+        state.player_add(p1)
+        state.player_add(p2)
+        state.spawn()
+        turns = []
+        state._player_action = lambda player, action: turns.append((player, action))
+
+        state.action_add(p2, Player.DOWN)
+        state.action_add(p2, Player.UP)
+        state.action_add(p1, Player.LEFT)
+        state._actions_process()
+        assert turns == [(p2, Player.DOWN), (p1, Player.LEFT)]
+
+        del turns[:]
+        state.action_add(p1, Player.RIGHT)
+        state._actions_process()
+        assert turns == [(p2, Player.UP), (p1, Player.RIGHT)]
+        assert state._action_queues == {}
+
+    def test_actions_flood(self):
+        """A flood of actions is bounded, and can be coalesced"""
+        state = GameState()
+        p1 = Player()
+        state.player_add(p1)
+        state.spawn()
+        state.action_queue_max = 4
+        for _ in xrange(100):
+            state.action_add(p1, Player.DOWN)
+        assert len(state._action_queues[p1]) == 4
+
+        state._action_queues.clear()
+        state.action_coalesce = True
+        for action in Player.DOWN, Player.BOMB, Player.UP, Player.BOMB, Player.RIGHT:
+            state.action_add(p1, action)
+        assert [action for _, action in state._action_queues[p1]] == [Player.BOMB, Player.RIGHT]
+
     def test_actions_bomb_non_sticky(self):
         """Queue a bomb action and ensure that it is not sticky"""
         state = GameState()
@@ -258,6 +548,33 @@ class TestGameState(TestCase):
         assert not state.arena.coords_have_obj((2, 1), p1)
         assert state.arena.coords_have_obj((1, 1), p1)
 
+    def test_passable(self):
+        """The blocked bitmap follows blocks being destroyed and bombs coming and going"""
+        state = GameState()
+        p1 = Player()
+        state.player_add(p1)
+        state.spawn()
+
+        assert not state.passable((0, 0))
+        assert not state.passable((-1, 1))
+        assert not state.passable((1, 3))
+        assert state.passable((1, 1))
+        assert state.passable((2, 1))
+
+        bomb = p1.drop_bomb()
+        assert not state.passable((1, 1))
+        state.arena.coords_get((1, 3))[0].flamed(None)
+        assert state.passable((1, 3))
+        bomb.remove()
+        assert state.passable((1, 1))
+
+        blocked = state.arena.blocked
+        assert sum(blocked) == sum(1 for x, y, l in state.arena if not state.passable((x, y)))
+
+        state.action_add(p1, Player.UP)
+        state._actions_process()
+        assert p1.coords == (1, 1)
+
     def test_bomb_mechanics(self):
         """Add a bomb and tick the game to blow it up"""
         state = GameState()
@@ -670,6 +987,25 @@ class TestGameState(TestCase):
         assert p8.deaths == 1
         assert p8.suicides == 0
 
+    def test_chain_explosion_long(self):
+        """Long chains of bombs don't run out of stack"""
+        length = 5000
+        state = GameState()
+        state.arena_build(['B' * (length+2), 'B' + ' ' * length + 'B', 'B' * (length+2)])
+        p1 = Player()
+        p1.bomb = length
+        p1.spawn(1, state=state, coords=(1, 1))
+        bombs = []
+        for x in xrange(1, length+1):
+            p1.coords = (x, 1)
+            bombs.append(Bomb(p1))
+
+        p1.coords = (1, 1)
+        bombs[0].explode()
+        assert all(b.exploded for b in bombs)
+        assert p1._bombs_live == []
+        assert state.arena.coords_have_class((length, 1), FlameCross)
+
     def test_flame_stops_at_destructable(self):
         state = GameState()
         p1 = Player()
@@ -702,6 +1038,65 @@ class TestGameState(TestCase):
         state.action_add(p1, Player.DOWN)
         state.tick()
 
+    def test_dead_players_forgotten(self):
+        """Players who die drop out of the players ticked, until they spawn again"""
+        state = GameState()
+        p1 = Player()
+        p2 = Player()
+        state.player_add(p1)
+        state.player_add(p2)
+        state.spawn()
+        assert list(state._alive) == [p1, p2]
+
+        state.action_add(p1, Player.BOMB)
+        state.tick(5)
+        assert p1.coords is None
+        assert list(state._alive) == [p2]
+        assert p1 not in state._sticky_actions
+
+        state.action_add(p1, Player.DOWN)
+        state.tick()
+        assert p1 not in state._sticky_actions
+
+        state.player_add(p1)
+        state.spawn()
+        assert list(state._alive) == [p2, p1]
+        assert state._sticky_actions[p1] is None
+
+    def test_action_invalid(self):
+        """Anything that isn't an action, such as another Player attribute a client names, is ignored"""
+        state = GameState()
+        p1 = Player()
+        state.player_add(p1)
+        state.spawn()
+        for junk in Player.DEBUG_CHR, Player.flame, 0, 6, None:
+            state.action_add(p1, junk)
+        assert not state._action_queues
+        state.snapshot([p1])
+
+    def test_player_queue(self):
+        """Players who leave before they spawn don't spawn"""
+        state = GameState()
+        p1 = Player()
+        p2 = Player()
+        state.player_add(p1)
+        state.player_add(p2)
+        state.player_remove(p1) # not in the arena yet, so there's nothing to remove there
+        state.spawn()
+        assert p1.coords is None
+        assert p2.number == 1
+
+    def test_player_remove_dead(self):
+        """Players who leave after dying are just forgotten"""
+        state = GameState()
+        p = Player()
+        state.player_add(p)
+        state.spawn()
+        p.remove()
+        p.coords = None
+        state.player_remove(p)
+        assert p not in state._alive
+
     def test_player_removal(self):
         state = GameState()
         p1 = Player()
@@ -807,6 +1202,26 @@ class TestGameState(TestCase):
 
         assert state.arena.coords_have_class(( 9, 5), FlameEndDown),  state.arena.coords_get(( 9, 5))
 
+    def test_flame_merge(self):
+        """Overlapping flames are one flame with the arms of all of them"""
+        state = GameState()
+        state.arena_load(["arenas", "empty.bmm"])
+        p1 = Player()
+        state.player_add(p1)
+        state.spawn()
+        bomb = Bomb(p1)
+
+        flame = Flame.ignite(bomb, (3, 1), ARM_UP)
+        assert type(flame) is FlameEndUp
+        assert Flame.ignite(bomb, (3, 1), ARM_DOWN) is flame
+        assert type(flame) is FlameVt
+        assert Flame.ignite(bomb, (3, 1), ARMS_HZ) is flame
+        assert type(flame) is FlameCross
+        assert [o for o in state.arena.coords_get((3, 1)) if isinstance(o, Flame)] == [flame]
+        assert str(state).split('\n')[1][3] == '+'
+
+        assert [FLAME_KINDS[arms].DEBUG_CHR for arms in (ARM_LEFT, ARMS_HZ, ARM_RIGHT | ARM_DOWN)] == ['<', '-', '+']
+
     def test_bomb_double_removal(self):
         state = GameState()
         state.arena_load(["arenas", "empty.bmm"])
@@ -878,3 +1293,579 @@ class TestGameState(TestCase):
         state.tick()
         state.tick()
         state.tick()
+
+class TestTickLoop(TestCase):
+
+    """Tests for the fixed timestep loop"""
+
+    def setUp(self):
+        self.now = 0.0
+        self.scheduled = []
+        self.ran = []
+        self.loop = TickLoop(0.25,
+                             [(4, lambda: self.ran.append('flames')),
+                              (1, lambda: self.ran.append('actions')),
+                              (4, lambda: self.ran.append('bombs'))],
+                             call_later=lambda delay, f: self.scheduled.append(delay),
+                             clock=lambda: self.now)
+
+    def test_phases(self):
+        """Phases run at their multiples of the base tick, in order"""
+        self.loop.start()
+        for n in xrange(1, 5):
+            self.now = n * 0.25
+            self.loop.run()
+
+        assert self.ran == ['flames', 'actions', 'bombs', 'actions', 'actions', 'actions',
+                            'flames', 'actions', 'bombs']
+
+    def test_drift_correction(self):
+        """Time spent processing is taken off the next delay"""
+        self.loop.start()
+        self.now = 0.3
+        self.loop.run()
+        assert self.scheduled == [0.25, 0.2]
+        assert self.loop.tick == 2
+
+    def test_skipped(self):
+        """Falling a long way behind skips ticks, and says so"""
+        reports = []
+        self.loop.report = lambda skipped, overran, stepped: reports.append((skipped, overran, stepped))
+        self.loop.start()
+        self.now = 10.0
+        self.loop.run()
+        assert self.loop.tick == 1 + self.loop.max_lag
+        assert self.loop.skipped == 40 - self.loop.max_lag
+        assert reports == [(40 - self.loop.max_lag, 0, 0)]
+
+    def test_clock_step(self):
+        """A clock that steps back doesn't stall the loop: it carries on from now, and says so"""
+        reports = []
+        self.loop.report = lambda skipped, overran, stepped: reports.append((skipped, overran, stepped))
+        self.loop.start()
+        self.now = 0.25
+        self.loop.run()
+        self.now = -99.5 # the wall clock set back 100s
+        self.loop.run()
+        assert self.loop.tick == 3
+        assert self.loop.clock_steps == 1
+        assert reports == [(0, 0, 99.75)]
+        assert self.scheduled[-1] == 0.25
+        self.now = -99.25
+        self.loop.run()
+        assert self.loop.tick == 4
+        assert self.scheduled[-1] == 0.25
+
+class TestTimingWheel(TestCase):
+
+    """Tests for the timing wheel"""
+
+    def test_advance(self):
+        """Items come back on the tick they're due, in order"""
+        wheel = TimingWheel()
+        assert wheel.schedule(2, 'a') == 2
+        assert wheel.schedule(1, 'b') == 1
+        assert wheel.schedule(2, 'c') == 2
+        assert len(wheel) == 3
+        assert wheel.advance() == ['b']
+        assert wheel.advance() == ['a', 'c']
+        assert wheel.advance() == []
+        assert len(wheel) == 0
+
+class TestUdeque(TestCase):
+
+    """Tests for the unique deque"""
+
+    def test_unique(self):
+        """Items are only queued once, wherever they're appended"""
+        q = udeque()
+        q.append('a')
+        q.append('b')
+        q.appendleft('c')
+        q.append('a')
+        q.appendleft('b')
+        assert list(q) == ['c', 'a', 'b']
+        assert list(reversed(q)) == ['b', 'a', 'c']
+        assert len(q) == 3
+        assert 'a' in q and 'd' not in q
+
+    def test_pop_remove(self):
+        """Items come off either end, or from the middle"""
+        q = udeque('abcde')
+        assert q.pop() == 'e'
+        assert q.popleft() == 'a'
+        q.remove('c')
+        self.assertRaises(ValueError, q.remove, 'c')
+        q.discard('c')
+        assert list(q) == ['b', 'd']
+        q.append('c')
+        assert list(q) == ['b', 'd', 'c']
+        q.clear()
+        assert not q
+        self.assertRaises(IndexError, q.pop)
+        self.assertRaises(IndexError, q.popleft)
+
+class TestHeadless(TestCase):
+
+    """Tests for the headless runner"""
+
+    def test_script(self):
+        """Scripted inputs are queued on their tick, and frames captured"""
+        state = GameState()
+        state.arena_load(["arenas", "empty.bmm"])
+        p1 = Player()
+        p2 = Player()
+        state.player_add(p1)
+        state.player_add(p2)
+        state.spawn()
+        script = [(0, 0, Player.DOWN), (2, 1, Player.LEFT), (2, 0, Player.UP)]
+        runner = Headless(state, [p1, p2], script, capture=True)
+        start1, start2 = p1.coords, p2.coords
+        runner.run(3)
+        # down is sticky, so p1 went down twice before going back up
+        assert p1.coords == (start1[0], start1[1] + 1)
+        assert p2.coords == (start2[0] - 1, start2[1])
+        assert len(runner.frames) == 3
+        assert runner.frames[-1] == str(state)
+
+    def test_callback(self):
+        """Callback inputs are asked for on every tick"""
+        state = GameState()
+        p1 = Player()
+        state.player_add(p1)
+        state.spawn()
+        ticks = []
+
+        def inputs(tick, state, players):
+            ticks.append(tick)
+            return [(players[0], Player.BOMB)]
+
+        runner = Headless(state, [p1], inputs)
+        assert runner.run(5) > 0
+        assert ticks == range(5)
+        assert p1.coords is None
+
+class TestSnapshot(TestCase):
+
+    """Tests for snapshotting and restoring game states"""
+
+    def test_restore(self):
+        """Restored games look the same, snapshot the same and carry on the same"""
+        state = GameState(seed=5)
+        state.action_queue_max = 3
+        players = [Player() for _ in xrange(6)]
+        runner = Headless(state, players, random_bots(seed=5, chance=0.8))
+        for ticks in 7, 13, 2, 30, 21, 9:
+            runner.run(ticks)
+            state.action_add(players[0], Player.BOMB)
+            state.action_add(players[1], Player.LEFT)
+            blob = state.snapshot(players)
+            restored, restored_players = GameState.restore(blob)
+            restored_players = restored_players[:len(players)]
+            assert str(restored) == str(state)
+            assert restored.version == state.version
+            assert restored.snapshot(restored_players) == blob
+
+            original = Headless(state, players, random_bots(seed=ticks), capture=True)
+            copy = Headless(restored, restored_players, random_bots(seed=ticks), capture=True)
+            original.run(40)
+            copy.run(40)
+            assert original.frames == copy.frames
+            assert restored.snapshot(restored_players) == state.snapshot(players)
+
+    def test_players(self):
+        """Players come back in the order given, waiting or not, with their stats"""
+        state = GameState(seed=1)
+        p1, p2, p3 = Player(), Player(), Player()
+        p1.name = 'one'
+        p1.kills = 3
+        for p in p1, p2:
+            state.player_add(p)
+        state.spawn()
+        state.player_add(p3)
+        state.action_add(p2, Player.BOMB)
+
+        restored, players = GameState.restore(state.snapshot([p3, p1]))
+        r3, r1, r2 = players
+        assert (r1.name, r1.kills, r1.number, r1.coords) == ('one', 3, p1.number, p1.coords)
+        assert r2.coords == p2.coords
+        assert r3.coords is None and list(restored._player_queue) == [r3]
+        assert list(restored._alive) == [r1, r2]
+
+        restored.tick()
+        assert restored.arena.coords_have_class(r2.coords, Bomb)
+        assert r2._bombs_live[0].original_owner is r2
+
+    def test_invalid(self):
+        """Anything but a snapshot is refused"""
+        self.assertRaises(ValueError, GameState.restore, 'BOMBREPL' + '\0' * 20)
+
+class TestReplay(TestCase):
+
+    """Tests for seeded games and replaying their input logs"""
+
+    def play(self, state, ticks=300, leave=None):
+        """Play a game with random bots, respawning them and maybe losing one; returns the frames"""
+        players = [Player() for _ in xrange(4)]
+        inputs = random_bots(seed=1)
+
+        def leaving(tick, state, players):
+            # the first player leaves on the first tick from leave on that they're in the arena
+            if leave is not None and tick >= leave and len(players) == 4 and players[0].coords is not None:
+                state.player_remove(players.pop(0))
+            return inputs(tick, state, players)
+
+        runner = Headless(state, players, leaving, capture=True)
+        runner.run(ticks)
+        return runner.frames
+
+    def test_seeded(self):
+        """Games with the same seed and inputs play out the same, powerups and all"""
+        frames = self.play(GameState(seed=3))
+        assert frames == self.play(GameState(seed=3))
+        assert any('f' in frame or 'b' in frame for frame in frames)
+
+    def test_replay(self):
+        """A recorded game replays the same from its log"""
+        state = GameState(seed=3)
+        state.every = (4, 1, 4)
+        fp = StringIO()
+        recording = InputLog(fp)
+        state.record(recording)
+        frames = self.play(state, leave=100)
+        assert not recording.inputs and not recording.hashes # written out rather than kept
+
+        fp.seek(0)
+        log = InputLog.load(fp)
+        assert log.ticks == 300
+        replay = Replay.from_log(log)
+        replay.run()
+        assert str(replay.state) == frames[-1]
+        assert replay.state.now == 300
+
+    def test_crash_log_junk(self):
+        """Inputs that aren't actions never reach the queues, so the crash log's snapshots keep working"""
+        state = GameState(seed=3)
+        crash = CrashLog(ticks=4)
+        state.record(crash)
+        p1 = Player()
+        state.player_add(p1)
+        state.spawn()
+        for _ in xrange(10):
+            state.action_add(p1, Player.DEBUG_CHR)
+            state.action_add(p1, Player.flame)
+            state.tick()
+        assert not state._action_queues
+        assert [action for _, _, action in crash.inputs()] == []
+        assert str(crash.last_state(state.now)) == str(state)
+
+    def test_leave_waiting_or_dead(self):
+        """Players who leave while waiting to spawn or after dying don't stop a log replaying"""
+        state = GameState(seed=3)
+        log = InputLog()
+        crash = CrashLog(ticks=16)
+        state.record(log)
+        state.record(crash)
+        bots = random_bots(seed=1)
+        waiting = Player()
+        left = []
+
+        def inputs(tick, state, players):
+            if tick == 1:
+                state.player_add(waiting) # the bots have taken every spawn point
+            elif tick == 10:
+                state.player_remove(waiting)
+            elif not left and players[0].coords is None and tick > 10:
+                left.append(players.pop(0))
+                state.player_remove(left[0])
+            return bots(tick, state, players)
+
+        runner = Headless(state, [Player() for _ in xrange(4)], inputs, capture=True)
+        runner.run(300)
+        assert waiting.coords is None and left
+
+        replay = Replay.from_log(log)
+        replay.run()
+        assert str(replay.state) == runner.frames[-1]
+        assert str(crash.last_state(state.now)) == runner.frames[-1]
+
+    def test_mismatch(self):
+        """Replays that go differently are caught on the first frame that differs"""
+        state = GameState(seed=3)
+        log = InputLog()
+        state.record(log)
+        self.play(state, ticks=50)
+        log.hashes[20] ^= 1
+        replay = Replay.from_log(log)
+        with self.assertRaises(ReplayMismatch) as raised:
+            replay.run()
+        assert raised.exception.tick == 20
+        assert replay.state.now == 20
+
+    def test_keyframes(self):
+        """Seeking in a keyframed replay file lands on the same frames as playing from the start"""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        state = GameState(seed=3)
+        writer = ReplayWriter(open(path, 'wb'), keyframe_every=40)
+        state.record(writer)
+        frames = [str(state)] + self.play(state, leave=100)
+        writer.close()
+
+        reader = ReplayReader(path)
+        self.addCleanup(reader.close)
+        assert reader.ticks == 300
+        assert reader.segments == 8
+        for tick in 0, 1, 39, 40, 41, 150, 280, 299, 300:
+            replay = reader.seek(tick)
+            assert replay.state.now == tick
+            assert str(replay.state) == frames[tick], tick
+
+        assert list(reader.frames(95, 130)) == list(enumerate(frames))[95:130]
+        assert [frame for _, frame in reader.frames()] == frames
+        self.assertRaises(IndexError, reader.seek, 301)
+
+    def test_keyframes_under_way(self):
+        """A keyframed replay of a game under way seeks by the ticks its keyframes were taken on"""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        state = GameState(seed=3)
+        self.play(state, ticks=150)
+        writer = ReplayWriter(open(path, 'wb'), keyframe_every=40)
+        state.record(writer)
+        frames = [str(state)] + self.play(state, ticks=150, leave=20)
+        writer.close()
+
+        reader = ReplayReader(path)
+        self.addCleanup(reader.close)
+        assert (reader.start, reader.ticks) == (150, 300)
+        assert reader.segments == 5 # from 150, 160, 200, 240 and 280
+        for tick in 150, 151, 159, 160, 170, 199, 200, 250, 299, 300:
+            replay = reader.seek(tick)
+            assert replay.state.now == tick
+            assert str(replay.state) == frames[tick - 150], tick
+
+        assert [frame for _, frame in reader.frames()] == frames
+        self.assertRaises(IndexError, reader.seek, 100)
+        self.assertRaises(IndexError, reader.seek, 149)
+
+    def test_record_under_way(self):
+        """Recording a game that's under way starts from a snapshot of it"""
+        state = GameState(seed=3)
+        self.play(state, ticks=50)
+        log = InputLog()
+        state.record(log)
+        frames = self.play(state, ticks=100, leave=20)
+
+        assert 'snapshot' in log.header
+        replay = Replay.from_log(log)
+        replay.run()
+        assert replay.state.now == 150
+        assert str(replay.state) == frames[-1]
+
+    def test_crash_log(self):
+        """A crash log works out the game going into the tick that crashed, and logs the inputs to play it again"""
+        state = GameState(seed=3)
+        crash = CrashLog(ticks=16)
+        state.record(crash)
+        runner = Headless(state, [Player() for _ in xrange(4)], random_bots(seed=1), capture=True)
+        runner.run(203)
+
+        bombs_process = state._bombs_process
+        def crashing():
+            bombs_process()
+            raise RuntimeError("crashed")
+        state._bombs_process = crashing
+        self.assertRaises(RuntimeError, runner.run, 1)
+
+        last = crash.last_state(state.now)
+        assert last.now == 203
+        last.tick() # with the inputs for the tick, a respawn among them, it goes as it did up to the crash
+        assert str(last) == str(state)
+
+        fp = StringIO()
+        crash.dump(fp, state, RuntimeError("crashed"))
+        assert fp.getvalue().startswith("RuntimeError('crashed',)\nlast_state =\n")
+        assert "state =\n%s\n" % state in fp.getvalue()
+
+        fp = StringIO()
+        crash.write(fp, state.now)
+        fp.seek(0)
+        replay = Replay.from_log(InputLog.load(fp))
+        assert replay.state.now == 192
+        replay.run(11)
+        assert str(replay.state) == runner.frames[-1]
+        replay.run()
+        assert replay.state.now == 204
+        assert str(replay.state) == str(state)
+
+class TestMetrics(TestCase):
+
+    """Tests for the game's counts and the timing of its phases"""
+
+    def setUp(self):
+        self.state = GameState(seed=0, arena=None)
+        self.state.arena_build(["BBBBBBB",
+                                "BS    B",
+                                "B B B B",
+                                "B     B",
+                                "BBBBBBB"])
+        self.player = Player()
+        self.state.player_add(self.player)
+        self.state.spawn()
+        PowerupFlame(self.state, (2, 1))
+
+    def play(self, ticks=8):
+        """Pick up the powerup, drop a bomb and get out of its way, on down to the bottom row"""
+        for action in Player.RIGHT, Player.BOMB, Player.RIGHT, Player.DOWN:
+            self.state.action_add(self.player, action)
+        self.state.tick(ticks)
+
+    def test_counts(self):
+        """The game counts explosions, flames, moves and pickups as they happen"""
+        self.play()
+        state = self.state
+        assert self.player.coords == (3, 3)
+        assert (state.explosions, state.flames_made, state.moves, state.pickups) == (1, 4, 4, 1)
+
+    def test_histogram(self):
+        """Percentiles are the upper bounds of the buckets they fall in, up to the longest duration"""
+        h = Histogram()
+        assert h.percentile(50) == 0
+        for seconds in [3e-6] * 98 + [0.01, 0.5]:
+            h.add(seconds)
+        assert h.count == 100
+        assert h.percentile(50) == 4e-6
+        assert h.percentile(99) == 0.016384
+        assert h.percentile(100) == h.max == 0.5
+        h.add(100)
+        assert h.percentile(100) == 100
+
+    def test_timing(self):
+        """Attached, each phase is timed as it runs, without changing how the game goes"""
+        self.state.every = (2, 1, 2)
+        metrics = TickMetrics(self.state, clock=count().next) # every phase takes a second
+        metrics.attach()
+        self.play(ticks=12)
+        assert self.player.coords == (3, 3)
+        assert self.state.explosions == 1
+
+        report = metrics.report()
+        assert report['ticks'] == 12
+        assert dict((name, phase['count']) for name, phase in report['phases'].items()) == dict(flames=6, actions=12, bombs=6)
+        assert report['phases']['actions']['sum'] == 12
+        assert report['phases']['actions']['p50'] == report['phases']['actions']['max'] == 1
+        assert report['counts'] == dict(explosions=1, flames_made=4, moves=4, pickups=1)
+        assert report['live'] == dict(bombs=0, flames=0, powerups=0, destructible_blocks=0, players=1)
+
+        metrics.detach()
+        self.state.tick()
+        assert metrics.phases['actions'].count == 12
+        assert '_actions_process' not in self.state.__dict__
+
+    def test_prometheus(self):
+        """Prometheus text has a type for each metric, and a sample per line"""
+        metrics = TickMetrics(self.state)
+        metrics.attach()
+        self.state.action_add(self.player, Player.UP)
+        self.state.action_add(self.player, Player.UP)
+        self.play()
+
+        text = metrics.prometheus()
+        lines = text.splitlines()
+        assert text.endswith('\n')
+        assert 'bomber_phase_seconds_count{phase="actions"} 8' in lines
+        assert 'bomber_phase_seconds_bucket{phase="bombs",le="+Inf"} 8' in lines
+        assert 'bomber_moves_total 4' in lines
+        assert 'bomber_live_objects{kind="players"} 1' in lines
+        assert 'bomber_actions_queued 0' in lines
+        for line in lines:
+            if line.startswith('# TYPE'):
+                assert line.split()[3] in ('counter', 'gauge', 'histogram')
+            elif not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                float(value)
+
+@skipIf(batch is None, "needs numpy")
+class TestBatch(TestCase):
+
+    """Tests for the batch engine, against GameState"""
+
+    CROWDED = ["BBBBBBBBB",
+               "BSS.....B",
+               "BSS.B.B.B",
+               "B.......B",
+               "B.B.B.B.B",
+               "B.....SSB",
+               "BBBBBBBBB"]
+
+    def assert_matches(self, lines, players, actions, setup=None):
+        """
+        Play the same games both ways, checking every tick; actions is ticks x
+        games x players, and setup(state, engine, g) is called with one or the other
+        """
+        ticks, games = len(actions), len(actions[0])
+        engine = batch.BatchGame(lines, games, players, seeds=range(games))
+        engine._stack = engine._stack[:, :1] # so that the stacks have to grow
+        if setup:
+            for g in xrange(games):
+                setup(None, engine, g)
+
+        results = []
+        for tick in xrange(ticks):
+            engine.step(numpy.array(actions[tick]))
+            results.append([(engine.render(g), [(engine.coords(g, n), engine.kills[g, n], engine.deaths[g, n], engine.suicides[g, n],
+                                                 engine.flame[g, n], engine.bomb[g, n]) for n in xrange(players)])
+                            for g in xrange(games)])
+
+        for g in xrange(games):
+            state = GameState(seed=g)
+            state.arena_build(lines)
+            ps = [Player() for _ in xrange(players)]
+            for p in ps:
+                state.player_add(p)
+            state.spawn()
+            if setup:
+                setup(state, None, g)
+
+            for tick in xrange(ticks):
+                for n, p in enumerate(ps):
+                    if actions[tick][g][n]:
+                        state.action_add(p, actions[tick][g][n])
+                state.tick()
+                frame, stats = results[tick][g]
+                assert frame == str(state), (tick, g)
+                assert stats == [(p.coords, p.kills, p.deaths, p.suicides, p.flame, p.bomb) for p in ps], (tick, g)
+
+    def random_actions(self, ticks, games, players, seed=0):
+        rand = random.Random(seed)
+        return [[[rand.choice([Player.UP, Player.DOWN, Player.LEFT, Player.RIGHT, Player.BOMB, Player.BOMB])
+                  if rand.random() < 0.5 else 0 for _ in xrange(players)]
+                 for _ in xrange(games)]
+                for _ in xrange(ticks)]
+
+    def test_default_arena(self):
+        """Random play on the default arena, powerups and all"""
+        lines = [line.rstrip() for line in codecs.open("arenas/default.bmm", 'r', 'UTF-8')]
+        self.assert_matches(lines, 4, self.random_actions(100, 4, 4))
+
+    def test_crowded(self):
+        """Chain reactions and kills, with players on top of each other"""
+        self.assert_matches(self.CROWDED, 6, self.random_actions(100, 6, 6, seed=1))
+
+    def test_pickups(self):
+        """Powerups picked up make for more and longer flames"""
+        def setup(state, engine, g):
+            if state:
+                PowerupFlame(state, (3, 1))
+                PowerupBomb(state, (4, 1))
+            else:
+                engine.powerup[g, 3 + engine.cols] = batch.POWERUP_FLAME
+                engine.powerup[g, 4 + engine.cols] = batch.POWERUP_BOMB
+
+        script = [Player.RIGHT, 0, 0, Player.BOMB, Player.LEFT, Player.BOMB, Player.LEFT] + [0] * 6
+        self.assert_matches(self.CROWDED[:1] + ["B S     B"] + self.CROWDED[2:], 1, [[[action]] for action in script])
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""Fixed timestep game loop"""
+
+import time
+
+# python 2 has no monotonic clock in the standard library; the wall clock can step backwards, which run() copes with
+monotonic = getattr(time, 'monotonic', time.time)
+
+class TickLoop(object):
+
+    """
+    Run phases at multiples of a fixed base tick, scheduled against a clock so
+    that the time spent processing doesn't slow the game down
+    """
+
+    def __init__(self, base, phases, call_later, clock=monotonic, max_lag=4, after=None, report=None):
+        """
+        phases is a list of (every, function) pairs, run in order on each base
+        tick that is a multiple of every; call_later(delay, function) schedules
+        the next run
+        """
+        self.base = base
+        self.phases = phases
+        self.call_later = call_later
+        self.clock = clock
+        self.max_lag = max_lag # ticks to catch up on before skipping
+        self.after = after # called after each run that processed ticks
+        self.report = report # called with (skipped, overran, stepped back seconds) when we fall behind or the clock steps back
+
+        self.tick = 0
+        self.skipped = 0
+        self.overruns = 0
+        self.clock_steps = 0
+        self.started = None
+
+    def start(self):
+        """Run the first tick now and schedule the rest"""
+        self.started = self.clock()
+        self.run()
+
+    def step(self):
+        """Run the phases due on the current tick"""
+        for every, f in self.phases:
+            if self.tick % every == 0:
+                f()
+
+        self.tick += 1
+
+    def run(self):
+        """Run the ticks that are due, then schedule the next"""
+        now = self.clock()
+        behind = int((now - self.started) / self.base) + 1 - self.tick
+        stepped = 0
+        if behind < 0:
+            # the clock went back past the last tick run: carry on from now, rather than wait for it to catch up
+            stepped = self.started + (self.tick - 1) * self.base - now
+            self.started = now - self.tick * self.base
+            self.clock_steps += 1
+            behind = 1
+
+        skipped = 0
+        if behind > self.max_lag:
+            # drop the excess, shifting the schedule so that the phases stay in step
+            skipped = behind - self.max_lag
+            self.started += skipped * self.base
+            self.skipped += skipped
+            behind = self.max_lag
+
+        overran = 0
+        for _ in xrange(behind):
+            before = self.clock()
+            self.step()
+            if self.clock() - before > self.base:
+                overran += 1
+
+        self.overruns += overran
+        if (skipped or overran or stepped) and self.report is not None:
+            self.report(skipped, overran, stepped)
+
+        if behind and self.after is not None:
+            self.after()
+
+        delay = self.started + self.tick * self.base - self.clock()
+        self.call_later(max(0, delay), self.run)
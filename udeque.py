@@ -1,20 +1,94 @@
 """A unique (set-like) version of deque"""
 
-from collections import deque
-
-class udeque(deque):
+class udeque(object):
 
     """
-    Modified deque with guards on the appends
-    NB. completely unoptimized; use only on small queues
+    Deque whose items are unique, kept as a doubly linked list threaded through
+    a dict, so that appends, pops, removal and membership are all O(1)
+    Appending an item that's already queued leaves it where it is
     """
 
+    def __init__(self, iterable=()):
+        self._root = root = [] # sentinel: root[0] is the last link, root[1] the first
+        root[:] = [root, root, None]
+        self._links = {} # item -> [prev link, next link, item]
+        for item in iterable:
+            self.append(item)
+
+    def _link(self, item, prev, succ):
+        """Link an item in between two links"""
+        link = [prev, succ, item]
+        prev[1] = succ[0] = self._links[item] = link
+
+    def _unlink(self, item):
+        """Unlink an item, returning it"""
+        prev, succ, item = self._links.pop(item)
+        prev[1] = succ
+        succ[0] = prev
+        return item
+
     def append(self, item):
-        """Wrapper for collections.deque.append()"""
-        if not item in list(self):
-            super(udeque, self).append(item)
+        """Add an item to the right, unless it's already queued"""
+        if item not in self._links:
+            self._link(item, self._root[0], self._root)
 
     def appendleft(self, item):
-        """Wrapper for collections.deque.appendleft()"""
-        if not item in list(self):
-            super(udeque, self).appendleft(item)
+        """Add an item to the left, unless it's already queued"""
+        if item not in self._links:
+            self._link(item, self._root, self._root[1])
+
+    def pop(self):
+        """Remove and return the rightmost item"""
+        if not self._links:
+            raise IndexError("pop from an empty udeque")
+
+        return self._unlink(self._root[0][2])
+
+    def popleft(self):
+        """Remove and return the leftmost item"""
+        if not self._links:
+            raise IndexError("pop from an empty udeque")
+
+        return self._unlink(self._root[1][2])
+
+    def remove(self, item):
+        """Remove an item from wherever it is in the queue"""
+        if item not in self._links:
+            raise ValueError("udeque.remove(x): x not in udeque")
+
+        self._unlink(item)
+
+    def discard(self, item):
+        """Remove an item if it's queued"""
+        if item in self._links:
+            self._unlink(item)
+
+    def clear(self):
+        """Remove all items"""
+        self._links.clear()
+        self._root[:] = [self._root, self._root, None]
+
+    def __contains__(self, item):
+        return item in self._links
+
+    def __len__(self):
+        return len(self._links)
+
+    def __iter__(self):
+        """Iterate from left to right"""
+        root = self._root
+        link = root[1]
+        while link is not root:
+            yield link[2]
+            link = link[1]
+
+    def __reversed__(self):
+        """Iterate from right to left"""
+        root = self._root
+        link = root[0]
+        while link is not root:
+            yield link[2]
+            link = link[0]
+
+    def __repr__(self):
+        return 'udeque(%r)' % list(self)
@@ -0,0 +1,31 @@
+"""A timing wheel, for things that happen a number of ticks from now"""
+
+class TimingWheel(object):
+
+    """
+    Schedule items against a tick count so that advancing a tick only touches
+    the items due on it; slots are keyed by absolute tick, so any delay fits
+    """
+
+    def __init__(self):
+        self.now = 0
+        self.slots = {}
+
+    def __len__(self):
+        """Number of scheduled entries, including any that will be skipped as stale"""
+        return sum(len(slot) for slot in self.slots.values())
+
+    def schedule(self, delay, item):
+        """Schedule an item delay ticks from now, returning the tick it is due on"""
+        tick = self.now + delay
+        try:
+            self.slots[tick].append(item)
+        except KeyError:
+            self.slots[tick] = [item]
+
+        return tick
+
+    def advance(self):
+        """Move on a tick, handing back the items due on it in the order they were scheduled"""
+        self.now += 1
+        return self.slots.pop(self.now, [])